@@ -0,0 +1,229 @@
+"""
+Command-line batch renderer for directories of multi-channel TIFF stacks
+
+Renders the composite stack and the image/histogram movie of every input
+with the same settings, in parallel over a process pool. Progress is
+recorded in the output directory so that interrupted runs resume, and
+inputs whose outputs are already current are skipped.
+
+Usage:
+    python batch_render.py 'Data/*.tif' --settings settings.json --output rendered --workers 4
+
+Example settings file (all keys optional):
+    {"colors": ["Red", "Cyan"], "contrast": [[0, 255], [20, 200]],
+     "projection": "mean", "projection_axis": 1,
+     "bins": 80, "fps": 15, "movie_format": "mp4", "precision": "float32",
+     "preprocessing": [{"background": "percentile", "filter": "gaussian", "sigma": 1}, null]}
+"""
+
+# License: BSD3
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+DEFAULT_SETTINGS = {
+    'colors': ['Red', 'Green', 'Blue'],
+    'contrast': [[0, 255], [0, 255], [0, 255]],
+    'projection': 'mean',
+    'projection_axis': 1,
+    'bins': None,
+    'fps': 15,
+    'movie_format': 'mp4',
+    'composite': True,
+    'movie': True,
+    'preprocessing': None,
+    'precision': 'float64',
+}
+
+PROGRESS_FILE = 'batch_progress.json'
+
+
+def load_settings(path = None):
+    '''Read a JSON settings file and fill in defaults'''
+
+    settings = dict(DEFAULT_SETTINGS)
+    if path is not None:
+        with open(path) as f:
+            settings.update(json.load(f))
+    unknown = set(settings) - set(DEFAULT_SETTINGS)
+    if unknown:
+        raise ValueError('Unknown settings: ' + ', '.join(sorted(unknown)))
+    if settings['projection'] not in ['mean', 'max', 'none']:
+        raise ValueError("projection must be 'mean', 'max' or 'none'")
+    return settings
+
+
+def find_inputs(patterns):
+    '''Expand directories (all .tif/.tiff files) and glob patterns into a sorted list of files'''
+
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            files += [os.path.join(pattern, f) for f in os.listdir(pattern)
+                      if f.lower().endswith(('.tif', '.tiff'))]
+        else:
+            files += glob.glob(pattern)
+    return sorted(set(os.path.abspath(f) for f in files))
+
+
+def job_key(path, settings):
+    '''Fingerprint of an input file and the settings, used to decide if outputs are current'''
+
+    stat = os.stat(path)
+    content = json.dumps([path, stat.st_size, stat.st_mtime_ns, settings], sort_keys = True)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def output_paths(path, settings, output_dir):
+    '''Return the output files produced for one input'''
+
+    base = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0])
+    outputs = []
+    if settings['composite']:
+        outputs.append(base + '_composite.tif')
+    if settings['movie']:
+        outputs.append(base + '_movie.' + settings['movie_format'])
+    return outputs
+
+
+def render_file(path, settings, output_dir):
+    '''Render the outputs of one input file and return the per-stage timings'''
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import skimage.io
+    from compcolor import Compositor, project
+
+    timings = {}
+    t0 = time.perf_counter()
+    image = skimage.io.imread(path)
+    dtype = np.float64 if settings['precision'] == 'float64' else np.float32
+    if settings['projection'] != 'none':
+        image = project(image, axis = settings['projection_axis'], method = settings['projection'], dtype = dtype)
+    timings['read_s'] = time.perf_counter() - t0
+
+    comp = Compositor(image, precision = settings['precision'])
+    if settings['preprocessing'] is not None:
+        t0 = time.perf_counter()
+        comp.set_preprocessing(settings['preprocessing'])
+        timings['preprocess_s'] = time.perf_counter() - t0
+    comp.selected_colors = list(settings['colors'])
+    comp.selected_contrast = [tuple(c) for c in settings['contrast']]
+
+    outputs = output_paths(path, settings, output_dir)
+    if settings['composite']:
+        t0 = time.perf_counter()
+        skimage.io.imsave(outputs[0], comp.composite_stack(), check_contrast = False)
+        timings['composite_s'] = time.perf_counter() - t0
+    if settings['movie']:
+        t0 = time.perf_counter()
+        #bins: None or a number of adaptive bins, or [start, stop, step] edges
+        bins = settings['bins']
+        if isinstance(bins, list):
+            bins = np.arange(*bins)
+        comp.movie_histogram_writer(outputs[-1], fps = settings['fps'], bins = bins)
+        timings['movie_s'] = time.perf_counter() - t0
+
+    return timings
+
+
+def read_progress(output_dir):
+    '''Load the progress record of previous runs'''
+
+    path = os.path.join(output_dir, PROGRESS_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def write_progress(output_dir, progress):
+    '''Atomically save the progress record'''
+
+    path = os.path.join(output_dir, PROGRESS_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(progress, f, indent = 2)
+    os.replace(path + '.tmp', path)
+
+
+def batch_render(inputs, settings, output_dir, workers = None, force = False):
+    '''Render all inputs over a process pool, skipping those whose outputs are current
+
+    Returns the progress dictionary with one entry per input file.'''
+
+    os.makedirs(output_dir, exist_ok = True)
+    progress = read_progress(output_dir)
+
+    todo = []
+    for path in inputs:
+        key = job_key(path, settings)
+        entry = progress.get(path)
+        current = (entry is not None and entry.get('key') == key and entry.get('status') == 'done'
+                   and all(os.path.exists(p) for p in output_paths(path, settings, output_dir)))
+        if current and not force:
+            print('skip   ', os.path.basename(path))
+        else:
+            todo.append((path, key))
+
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        futures = {pool.submit(render_file, path, settings, output_dir): (path, key) for path, key in todo}
+        for future in as_completed(futures):
+            path, key = futures[future]
+            try:
+                timings = future.result()
+                progress[path] = {'key': key, 'status': 'done', 'timings': timings,
+                                  'outputs': output_paths(path, settings, output_dir)}
+                print('done   ', os.path.basename(path), '{:.2f} s'.format(sum(timings.values())))
+            except Exception as e:
+                progress[path] = {'key': key, 'status': 'failed', 'error': repr(e)}
+                print('failed ', os.path.basename(path), repr(e))
+            write_progress(output_dir, progress)
+
+    return progress
+
+
+def print_summary(progress, inputs):
+    '''Print a per-file timing table of the given inputs'''
+
+    stages = ['read_s', 'preprocess_s', 'composite_s', 'movie_s']
+    print('{:<40}{:>10}{:>16}{:>14}{:>10}{:>10}'.format('file', 'read (s)', 'preprocess (s)', 'composite (s)',
+                                                        'movie (s)', 'status'))
+    for path in inputs:
+        entry = progress.get(path, {})
+        timings = entry.get('timings', {})
+        values = ['{:.2f}'.format(timings[s]) if s in timings else '-' for s in stages]
+        print('{:<40}{:>10}{:>16}{:>14}{:>10}{:>10}'.format(os.path.basename(path)[:39], *values,
+                                                            entry.get('status', '-')))
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Render composites and histogram movies of TIFF stacks')
+    parser.add_argument('inputs', nargs = '+', help = 'directories or glob patterns of TIFF stacks')
+    parser.add_argument('--settings', default = None, help = 'JSON settings file')
+    parser.add_argument('--output', default = 'rendered', help = 'output directory')
+    parser.add_argument('--workers', type = int, default = None, help = 'number of processes')
+    parser.add_argument('--force', action = 'store_true', help = 're-render outputs that are current')
+    args = parser.parse_args(argv)
+
+    settings = load_settings(args.settings)
+    inputs = find_inputs(args.inputs)
+    if not inputs:
+        parser.error('no input files found')
+
+    progress = batch_render(inputs, settings, args.output, workers = args.workers, force = args.force)
+    print_summary(progress, inputs)
+
+    failed = [p for p in inputs if progress.get(p, {}).get('status') != 'done']
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
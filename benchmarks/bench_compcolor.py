@@ -0,0 +1,277 @@
+"""
+Benchmark suite for the Combcol compositing, histogramming and export paths
+
+Usage:
+    python benchmarks/bench_compcolor.py --output results.json
+    python benchmarks/bench_compcolor.py --output new.json --compare results.json
+"""
+
+# License: BSD3
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.animation import FFMpegWriter
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+from compcolor import Combcol, Compositor, ReadAheadSource
+
+#(name, shape (T, C, Y, X), dtype)
+CASES = [
+    ('small_uint8_2c', (10, 2, 128, 128), np.uint8),
+    ('small_uint16_3c', (10, 3, 128, 128), np.uint16),
+    ('medium_uint16_2c', (20, 2, 512, 512), np.uint16),
+    ('medium_float64_3c', (20, 3, 512, 512), np.float64),
+    ('large_uint16_2c', (5, 2, 2048, 2048), np.uint16),
+]
+
+
+def synthetic_stack(shape, dtype, seed = 0):
+    '''Generate a (T, C, Y, X) stack of noisy blobs in the range of dtype'''
+
+    rng = np.random.default_rng(seed)
+    if np.issubdtype(dtype, np.integer):
+        top = min(np.iinfo(dtype).max, 4095)
+    else:
+        top = 1.0
+    image = rng.gamma(2.0, top / 20, size = shape)
+    yy, xx = np.mgrid[0:shape[2], 0:shape[3]]
+    for t in range(shape[0]):
+        cy, cx = shape[2] * (0.3 + 0.4 * t / shape[0]), shape[3] / 2
+        image[t] += 0.5 * top * np.exp(-((yy - cy)**2 + (xx - cx)**2) / (0.02 * shape[2] * shape[3]))
+    return np.clip(image, 0, top).astype(dtype)
+
+
+def measure(func, repeat = 3, setup = None):
+    '''Time func (best of repeat) and record its peak traced memory
+
+    setup, if given, is called untimed before each run of func.'''
+
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'best_s': min(times), 'mean_s': float(np.mean(times)), 'peak_bytes': peak}
+
+
+def widget_latency(cc, repeat = 3):
+    '''Time the interactive_colors callbacks triggered by slider changes, without a kernel'''
+
+    import IPython.display
+
+    captured = []
+    original_display = IPython.display.display
+    IPython.display.display = captured.append
+    try:
+        cc.interactive_colors()
+    finally:
+        IPython.display.display = original_display
+    plt.close('all')
+
+    widgets = captured[0].children[0].children[1], captured[0].children[2].children[0].children[0].children[1]
+    time_slider, contrast0 = widgets
+
+    #each run starts from the same reset state and every assignment changes the value,
+    #so that all events fire a callback, including the run under tracemalloc
+    nevents = min(repeat, time_slider.max)
+
+    def reset():
+        contrast0.value = (0, 255)
+        time_slider.value = 0
+        plt.close('all')
+
+    def move_contrast():
+        for lo in range(1, nevents + 1):
+            contrast0.value = (lo, 255 - lo)
+            plt.close('all')
+
+    def move_time():
+        for t in range(1, nevents + 1):
+            time_slider.value = t
+            plt.close('all')
+
+    results = {}
+    for name, func in [('contrast', move_contrast), ('time', move_time)]:
+        res = measure(func, repeat = 1, setup = reset)
+        res['per_event_s'] = res['best_s'] / nevents
+        results[name] = res
+    return results
+
+
+def import_time(repeat = 3):
+    '''Time a cold import of compcolor and of a first combine call in fresh interpreters'''
+
+    code = ('import time; t0 = time.perf_counter(); import compcolor; t1 = time.perf_counter(); '
+            'import numpy as np; im = np.zeros((2, 64, 64)); compcolor.Combcol(im).combine(im); '
+            'print(t1 - t0, time.perf_counter() - t1)')
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], cwd = REPO, capture_output = True,
+                             text = True, check = True).stdout.split()
+        times.append([float(x) for x in out])
+    times = np.array(times)
+    return {'import_s': float(times[:, 0].min()), 'first_combine_s': float(times[:, 1].min())}
+
+
+def readahead(tmpdir, latency = 0.02, depths = (0, 2, 8)):
+    '''Export a stack through a frame source with simulated read latency at several read-ahead depths'''
+
+    image = synthetic_stack((30, 2, 256, 256), np.uint16)
+
+    def read_frame(t):
+        time.sleep(latency)
+        return image[t]
+
+    results = {'latency_s': latency}
+    for depth in depths:
+        source = ReadAheadSource(read_frame, image.shape, image.dtype, depth = depth)
+        comp = Compositor(source)
+        t0 = time.perf_counter()
+        comp.export_movie(os.path.join(tmpdir, 'readahead.tif'))
+        stats = source.stats()
+        source.close()
+        results['depth_' + str(depth)] = {'best_s': time.perf_counter() - t0,
+                                          'io_wait_s': stats['io_wait_s'], 'compute_s': stats['compute_s']}
+    return results
+
+
+def run_case(name, shape, dtype, tmpdir, repeat):
+    '''Run all benchmarks for one synthetic stack'''
+
+    image = synthetic_stack(shape, dtype)
+    cc = Combcol(image)
+    results = {'shape': list(shape), 'dtype': np.dtype(dtype).name, 'input_bytes': image.nbytes}
+
+    results['combine'] = measure(lambda: cc.combine(image[0]), repeat)
+    reference = cc.combine(image[0])
+    for precision in ['float32', 'uint8']:
+        comp = Combcol(image, precision = precision)
+        res = measure(lambda: comp.combine(comp.image[0]), repeat)
+        result = comp.combine(comp.image[0])
+        result = result / 255 if result.dtype == np.uint8 else result
+        res['max_error'] = float(np.abs(reference - result).max())
+        res['image_bytes'] = comp.image.nbytes
+        results['combine_' + precision] = res
+    results['composite_stack'] = measure(lambda: [cc.combine(image[t]) for t in range(shape[0])], repeat)
+    results['composite_stack_plan'] = measure(cc.composite_stack, repeat)
+
+    def histograms():
+        cc.hist_cache = {}
+        for t in range(shape[0]):
+            cc.frame_histogram(t)
+    results['histogram_cached'] = measure(histograms, repeat)
+    def adaptive_histograms():
+        cc.hist_cache = {}
+        cc.intensity_range = None
+        for t in range(shape[0]):
+            cc.intensity_histogram(t)
+    results['histogram_adaptive'] = measure(adaptive_histograms, repeat)
+    results['histogram_plt_hist'] = measure(
+        lambda: [np.histogram(np.ravel(image[t, c]), bins = np.arange(0, 8000, 100))
+                 for t in range(shape[0]) for c in range(shape[1])], repeat)
+
+    results['export_gif'] = measure(lambda: cc.export_movie(os.path.join(tmpdir, name + '.gif')), 1)
+    results['export_tif'] = measure(lambda: cc.export_movie(os.path.join(tmpdir, name + '.tif')), 1)
+    results['export_gif_preview'] = measure(
+        lambda: cc.export_movie(os.path.join(tmpdir, name + '_preview.gif'), stride = 2, downscale = 4), 1)
+
+    if FFMpegWriter.isAvailable():
+        results['export_mp4'] = measure(
+            lambda: cc.movie_histogram_writer(os.path.join(tmpdir, name + '.mp4')), 1)
+        plt.close('all')
+    else:
+        results['export_mp4'] = None
+
+    results['widget_callback'] = widget_latency(cc, repeat)
+    return results
+
+
+def compare(new, old):
+    '''Print the ratios of best times and of peak memory between two result files'''
+
+    row = '{:<24}{:<28}{:>10}{:>10}{:>8}{:>12}{:>12}{:>8}'
+    print(row.format('case', 'benchmark', 'old (s)', 'new (s)', 'ratio', 'old (MB)', 'new (MB)', 'ratio'))
+
+    def print_row(case, bench, prev, val):
+        times = ['{:.4f}'.format(prev['best_s']), '{:.4f}'.format(val['best_s']),
+                 '{:.2f}'.format(val['best_s'] / prev['best_s'])]
+        if 'peak_bytes' in val and 'peak_bytes' in prev:
+            memory = ['{:.2f}'.format(prev['peak_bytes'] / 1e6), '{:.2f}'.format(val['peak_bytes'] / 1e6),
+                      '{:.2f}'.format(val['peak_bytes'] / prev['peak_bytes']) if prev['peak_bytes'] else '-']
+        else:
+            memory = ['-', '-', '-']
+        print(row.format(case, bench, *times, *memory))
+
+    if 'import' in old:
+        print(row.format('-', 'import', '{:.4f}'.format(old['import']['import_s']),
+                         '{:.4f}'.format(new['import']['import_s']),
+                         '{:.2f}'.format(new['import']['import_s'] / old['import']['import_s']), '-', '-', '-'))
+    for case, res in new['cases'].items():
+        if case not in old['cases']:
+            continue
+        for bench, val in res.items():
+            prev = old['cases'][case].get(bench)
+            if not isinstance(val, dict) or not isinstance(prev, dict):
+                continue
+            if 'best_s' not in val:
+                #nested results such as widget callbacks
+                for sub, subval in val.items():
+                    if isinstance(subval, dict) and isinstance(prev.get(sub), dict):
+                        print_row(case, bench + '.' + sub, prev[sub], subval)
+                continue
+            print_row(case, bench, prev, val)
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Benchmark compcolor')
+    parser.add_argument('--output', default = 'bench_results.json', help = 'JSON file to write')
+    parser.add_argument('--compare', default = None, help = 'previous JSON file to compare with')
+    parser.add_argument('--cases', nargs = '*', default = None, help = 'subset of case names to run')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'repetitions per timing')
+    args = parser.parse_args(argv)
+
+    results = {'meta': {'python': platform.python_version(), 'numpy': np.__version__,
+                        'platform': platform.platform(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')},
+               'import': import_time(args.repeat), 'cases': {}}
+    print('import compcolor: {:.3f} s'.format(results['import']['import_s']))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, shape, dtype in CASES:
+            if args.cases and name not in args.cases:
+                continue
+            print('running', name, shape, np.dtype(dtype).name)
+            results['cases'][name] = run_case(name, shape, dtype, tmpdir, args.repeat)
+        results['cases']['readahead'] = {'readahead': readahead(tmpdir)}
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 2)
+    print('results written to', args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
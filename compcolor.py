@@ -1,27 +1,440 @@
 """
-Class implementing a multi-channel image renderer
+Classes implementing a multi-channel image renderer
+
+Compositor is the widget-free compositing, statistics and export engine
+and only requires NumPy. Combcol adds the ipywidgets GUI on top of it.
+ipywidgets, Matplotlib and IPython are imported on first use by the GUI,
+plotting and export methods so that importing this module stays fast.
 """
 
 # Author: Guillaume Witz, Science IT Support, Bern University, 2020
 # License: BSD3
 
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import ipywidgets as ipw
-import skimage
-import matplotlib.pyplot as plt
-from matplotlib.animation import FFMpegWriter
-from IPython.display import HTML, display, Video
-import matplotlib.animation as animation
-import imageio
 
-from matplotlib.colors import ListedColormap
 
-class Combcol:
+def rescale_uint8(image, in_range = None, dtype = None):
+    '''Map in_range (default: image min/max) linearly to 0-255 and truncate to uint8
+    
+    Equivalent to skimage.exposure.rescale_intensity(image, in_range, out_range = np.uint8)
+    followed by a cast to uint8. If dtype is given the arithmetic is done in that float type.'''
+    
+    if dtype is not None:
+        image = image.astype(dtype, copy = False)
+    if in_range is None:
+        imin, imax = float(np.min(image)), float(np.max(image))
+    else:
+        imin, imax = float(in_range[0]), float(in_range[1])
+    
+    image = np.clip(image, imin, imax)
+    if imin != imax:
+        #same order of operations as skimage so that the rounding matches
+        image = (image - imin) / (imax - imin)
+        return (image * 255.0).astype(np.uint8)
+    else:
+        return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def project(image, axis = 1, method = 'mean', dtype = np.float64):
+    '''Project a stack along axis with 'mean' or 'max', returning an array of the given float dtype
+    
+    Use dtype = np.float32 to halve the memory of the projection compared to np.mean.'''
+    
+    if method == 'mean':
+        return np.mean(image, axis = axis, dtype = dtype)
+    elif method == 'max':
+        return np.max(image, axis = axis).astype(dtype, copy = False)
+    raise ValueError("method must be 'mean' or 'max'")
+
+
+PRECISIONS = ['float64', 'float32', 'uint8']
+
+
+def _ordered_map(func, items, workers):
+    '''Apply func to items on a thread pool and yield the results in order
+    
+    At most 2 * workers items are in flight, which bounds the memory held by results.'''
+    
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def tile_slices(shape, tile_size):
+    '''Return the (y, x) slices of the tiles covering a (Y, X) shape in row-major order'''
+    
+    return [(slice(y, min(y + tile_size, shape[0])), slice(x, min(x + tile_size, shape[1])))
+            for y in range(0, shape[0], tile_size) for x in range(0, shape[1], tile_size)]
+
+
+def bmp_bytes(rgb):
+    '''Encode a uint8 RGB image as an uncompressed top-down 24-bit BMP
+    
+    The payload is the raw pixel buffer in BGR order with a 54 byte header, so encoding
+    costs one copy and browsers can display it directly.'''
+    
+    h, w = rgb.shape[0:2]
+    row = 3 * w
+    pad = (-row) % 4
+    data = np.zeros((h, row + pad), dtype = np.uint8)
+    data[:,0:row] = rgb[:,:,2::-1].reshape(h, row)
+    header = (struct.pack('<2sIHHI', b'BM', 54 + data.size, 0, 0, 54)
+              + struct.pack('<IiiHHIIiiII', 40, w, -h, 1, 24, 0, data.size, 2835, 2835, 0, 0))
+    return header + data.tobytes()
+
+
+class FrameView:
+    '''Image display made of a grid of ipywidgets Image tiles
+    
+    Frames are sent as uncompressed BMP tiles, each a binary comm message. Only the
+    tiles whose pixels differ from what is displayed are sent. Preview updates send
+    the changed tiles subsampled, scaled up by the browser, and the next full
+    resolution update resends only the tiles that show a preview or changed.'''
+    
+    def __init__(self, shape, tile_size = 128, zoom = 1):
+        '''shape is the (Y, X) frame shape, zoom the display scale factor'''
+        
+        import ipywidgets as ipw
+        
+        self.shape = tuple(shape[0:2])
+        self.tile_size = tile_size
+        self.tiles = tile_slices(self.shape, tile_size)
+        columns = ' '.join(str(zoom * (sx.stop - sx.start))+'px' for sy, sx in self.tiles if sy.start == 0)
+        self.images = [ipw.Image(format = 'bmp', layout = ipw.Layout(width = str(zoom * (sx.stop - sx.start))+'px',
+                                                                     height = str(zoom * (sy.stop - sy.start))+'px'))
+                       for sy, sx in self.tiles]
+        self.widget = ipw.GridBox(self.images, layout = ipw.Layout(grid_template_columns = columns, grid_gap = '0px'))
+        
+        #(downscale, pixels) of the tile displayed in each slot
+        self.sent = [None] * len(self.tiles)
+        self.lock = threading.Lock()
+        self.stats = {'updates': 0, 'tiles_sent': 0, 'bytes_sent': 0}
+    
+    def update(self, rgb, downscale = 1):
+        '''Show a full resolution uint8 RGB frame, sending only tiles that differ from the display
+        
+        With downscale > 1 the changed tiles are sent subsampled by downscale as a preview;
+        tiles already displayed at full resolution with the same pixels are never resent.'''
+        
+        with self.lock:
+            self.stats['updates'] += 1
+            for i, (sy, sx) in enumerate(self.tiles):
+                tile = rgb[sy, sx]
+                previous = self.sent[i]
+                if previous is not None and previous[0] == 1 and np.array_equal(previous[1], tile):
+                    continue
+                if downscale > 1:
+                    tile = tile[::downscale, ::downscale]
+                    if previous is not None and previous[0] == downscale and np.array_equal(previous[1], tile):
+                        continue
+                data = bmp_bytes(tile)
+                self.images[i].value = data
+                self.sent[i] = (downscale, tile.copy())
+                self.stats['tiles_sent'] += 1
+                self.stats['bytes_sent'] += len(data)
+
+
+class ReadAheadSource:
+    '''Array-like (T, C, Y, X) image whose frames are read from disk with read-ahead
+    
+    Reading frame t schedules reads of the next depth frames (or previous ones when
+    stepping backwards) on a thread pool so that they load while t is rendered.
+    Indexing with an integer time point reads one frame, other indices read the
+    selected frames; np.asarray(source) reads the whole stack.'''
+    
+    def __init__(self, read_frame, shape, dtype, depth = 4, workers = 2, cache_size = None):
+        '''read_frame(t) returns frame t as a (C, Y, X) array
+        
+        depth is the number of frames read ahead (0 disables read-ahead) and
+        cache_size the number of frames kept in memory (default 2 * depth + 1).
+        Objects appended to resources (e.g. open files) are closed by close().'''
+        
+        self.read_frame = read_frame
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+        self.depth = depth
+        self.cache_size = cache_size if cache_size is not None else 2 * depth + 1
+        self.pool = ThreadPoolExecutor(max_workers = workers)
+        self.frames = OrderedDict()
+        self.lock = threading.Lock()
+        self.last_t = None
+        self.resources = []
+        self.reset_stats()
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+    
+    def reset_stats(self):
+        '''Clear the I/O counters'''
+        
+        self.io_stats = {'frames_read': 0, 'hits': 0, 'misses': 0, 'read_s': 0.0, 'io_wait_s': 0.0}
+        self.first_access = None
+    
+    def stats(self):
+        '''Return frames read, cache hits/misses, total read time in the workers, time the caller
+        waited for I/O and the remaining (compute) time since the first access'''
+        
+        stats = dict(self.io_stats)
+        elapsed = 0.0 if self.first_access is None else time.perf_counter() - self.first_access
+        stats['compute_s'] = max(0.0, elapsed - stats['io_wait_s'])
+        return stats
+    
+    def _read(self, t):
+        t0 = time.perf_counter()
+        frame = np.asarray(self.read_frame(t), dtype = self.dtype)
+        with self.lock:
+            self.io_stats['frames_read'] += 1
+            self.io_stats['read_s'] += time.perf_counter() - t0
+        return frame
+    
+    def _schedule(self, t):
+        if t not in self.frames:
+            self.frames[t] = self.pool.submit(self._read, t)
+        self.frames.move_to_end(t)
+    
+    def frame(self, t):
+        '''Return frame t, waiting for its read if necessary, and schedule the read-ahead
+        
+        Can be called from several threads; the cache is only modified under the lock,
+        which is released while waiting for the read.'''
+        
+        t = range(self.shape[0])[t]
+        with self.lock:
+            if self.first_access is None:
+                self.first_access = time.perf_counter()
+            
+            if t in self.frames:
+                self.io_stats['hits'] += 1
+            else:
+                self.io_stats['misses'] += 1
+            self._schedule(t)
+            
+            direction = -1 if self.last_t is not None and t < self.last_t else 1
+            self.last_t = t
+            for k in range(1, self.depth + 1):
+                if 0 <= t + direction * k < self.shape[0]:
+                    self._schedule(t + direction * k)
+            self.frames.move_to_end(t)
+            while len(self.frames) > max(self.cache_size, self.depth + 1):
+                self.frames.popitem(last = False)
+            future = self.frames[t]
+        
+        t0 = time.perf_counter()
+        frame = future.result()
+        with self.lock:
+            self.io_stats['io_wait_s'] += time.perf_counter() - t0
+        return frame
+    
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        first, rest = key[0], key[1:]
+        if first is Ellipsis:
+            first, rest = slice(None), (Ellipsis,) + rest
+        if isinstance(first, (int, np.integer)):
+            return self.frame(first)[rest]
+        times = np.arange(self.shape[0])[first]
+        return np.stack([self.frame(t)[rest] for t in np.atleast_1d(times)])
+    
+    def __array__(self, dtype = None, copy = None):
+        out = np.empty(self.shape, dtype = self.dtype if dtype is None else dtype)
+        for t in range(self.shape[0]):
+            out[t] = self.frame(t)
+        return out
+    
+    def close(self):
+        '''Cancel the pending reads, stop the reader threads and close the resources'''
+        
+        with self.lock:
+            for future in self.frames.values():
+                future.cancel()
+            self.frames.clear()
+        #wait for running reads so that the files they use can be closed
+        self.pool.shutdown(wait = True)
+        for resource in self.resources:
+            resource.close()
+        self.resources = []
+    
+    @classmethod
+    def from_tiff(cls, path, projection = 'mean', projection_axis = 1, depth = 4, workers = 2):
+        '''Source reading the time points of a (T, ..., C, Y, X) TIFF hyperstack page by page
+        
+        If projection is 'mean' or 'max', projection_axis of the file (e.g. Z in TZCYX)
+        is projected per frame. Requires tifffile.'''
+        
+        import tifffile
+        
+        with tifffile.TiffFile(path) as tif:
+            series = tif.series[0]
+            file_shape = series.shape
+            dtype = series.dtype
+            npages = len(series.pages)
+        pages_per_frame = npages // file_shape[0]
+        frame_shape = file_shape[1:]
+        if projection is not None and projection != 'none':
+            frame_shape = frame_shape[:projection_axis - 1] + frame_shape[projection_axis:]
+            dtype = np.float64
+        local = threading.local()
+        handles = []
+        
+        def read_frame(t):
+            #one file handle per reader thread, closed by close()
+            if not hasattr(local, 'tif'):
+                local.tif = tifffile.TiffFile(path)
+                handles.append(local.tif)
+            frame = local.tif.asarray(key = range(t * pages_per_frame, (t + 1) * pages_per_frame))
+            frame = frame.reshape(file_shape[1:])
+            if projection is not None and projection != 'none':
+                frame = project(frame, axis = projection_axis - 1, method = projection)
+            return frame
+        
+        source = cls(read_frame, (file_shape[0],) + frame_shape, dtype, depth = depth, workers = workers)
+        source.resources = handles
+        return source
+
+
+class LUT:
+    '''NumPy lookup table behaving like a matplotlib ListedColormap for 8-bit images'''
+    
+    def __init__(self, colors):
+        '''colors is an (N, 3) array of RGB values in [0, 1]'''
+        
+        self.colors = np.asarray(colors, dtype = np.float64)
+        self.N = self.colors.shape[0]
+        self.lut = np.c_[self.colors, np.ones(self.N)]
+    
+    def __call__(self, X):
+        '''Return the RGBA float image of X (integers index the table, floats span [0, 1])'''
+        
+        X = np.asarray(X)
+        if not np.issubdtype(X.dtype, np.integer):
+            X = (X * self.N).astype(np.intp)
+        return np.take(self.lut, np.clip(X, 0, self.N - 1), axis = 0)
+
+
+class RenderPlan:
+    '''Compiled compositing settings for rendering many frames of the same shape
+    
+    Holds the fused contrast/color LUT of each channel and preallocated rescale and
+    output buffers, so that rendering a frame only rescales it in place and applies
+    the LUTs. update() rebuilds only the LUTs of the channels whose color or contrast
+    changed. The result of render() equals to_rgb8(combine(frame)) of the compositor.'''
+    
+    def __init__(self, compositor, shape, dtype, colors, contrast, blend = 'max'):
+        '''shape is the (C, Y, X) frame shape and dtype the frame dtype
+        
+        blend is 'max' (maximum of the colored channels, as combine) or 'add'
+        (sum of the colored channels clipped to 255).'''
+        
+        if blend not in ['max', 'add']:
+            raise ValueError("blend must be 'max' or 'add'")
+        self.compositor = compositor
+        self.shape = tuple(shape)
+        self.blend = blend
+        
+        #arithmetic types of combine: frame rescale and LUTs
+        self.work_dtype = compositor.working_array(np.empty(0, dtype = dtype)).dtype
+        self.lut_dtype = compositor.lut_dtype()
+        
+        self.work = np.empty(self.shape, dtype = self.work_dtype)
+        self.levels = np.empty(self.shape, dtype = np.uint8)
+        self.rgb = np.empty(self.shape[1:3] + (3,), dtype = np.uint8)
+        self.scratch = np.empty(self.shape[1:3] + (3,), dtype = np.uint8)
+        self.headroom = np.empty(self.shape[1:3] + (3,), dtype = np.uint8) if blend == 'add' else None
+        
+        self.colors = [None] * self.shape[0]
+        self.contrast = [None] * self.shape[0]
+        self.luts = [None] * self.shape[0]
+        self.update(colors, contrast)
+    
+    def set_channel(self, c, color, contrast):
+        '''Set the color and contrast of channel c, rebuilding its LUT if they changed
+        
+        Returns True if the LUT was rebuilt.'''
+        
+        contrast = tuple(contrast)
+        if self.luts[c] is not None and self.colors[c] == color and self.contrast[c] == contrast:
+            return False
+        self.luts[c] = self.compositor.channel_lut(color, contrast, dtype = self.lut_dtype)
+        self.colors[c] = color
+        self.contrast[c] = contrast
+        return True
+    
+    def update(self, colors, contrast):
+        '''Set the colors and contrast of all channels and return the indices of the rebuilt channels'''
+        
+        return [c for c in range(self.shape[0]) if self.set_channel(c, colors[c], contrast[c])]
+    
+    def rescale(self, frame):
+        '''Rescale a (C, Y, X) frame to the uint8 levels buffer like combine does'''
+        
+        work = self.work
+        np.copyto(work, frame, casting = 'unsafe')
+        imin, imax = float(np.min(work)), float(np.max(work))
+        np.clip(work, imin, imax, out = work)
+        if imin != imax:
+            work -= imin
+            work /= imax - imin
+            work *= 255.0
+        else:
+            np.clip(work, 0, 255, out = work)
+        np.copyto(self.levels, work, casting = 'unsafe')
+        return self.levels
+    
+    def render(self, frame, out = None):
+        '''Composite a (C, Y, X) frame into a uint8 RGB image
+        
+        The result is written into out if given, else into a buffer of the plan
+        that the next render overwrites.'''
+        
+        if frame.shape != self.shape:
+            raise ValueError('frame shape {} does not match the plan shape {}'.format(frame.shape, self.shape))
+        comp = self.compositor
+        
+        t0 = comp._tic()
+        levels = self.rescale(frame)
+        comp._toc('rescale', t0)
+        
+        t0 = comp._tic()
+        rgb = self.rgb if out is None else out
+        np.take(self.luts[0], levels[0], axis = 0, out = rgb)
+        for c in range(1, self.shape[0]):
+            np.take(self.luts[c], levels[c], axis = 0, out = self.scratch)
+            if self.blend == 'max':
+                np.maximum(rgb, self.scratch, out = rgb)
+            else:
+                #saturating add: the new channel is limited to the room left below 255
+                np.subtract(255, rgb, out = self.headroom)
+                np.minimum(self.scratch, self.headroom, out = self.scratch)
+                rgb += self.scratch
+        comp._toc('colormap', t0)
+        return rgb
+
+
+class Compositor:
+    
+    _default_colormaps = None
     
     def __init__(self, image,
-                colors = ['Red','Green','Blue']):
+                colors = ['Red','Green','Blue'], profile = False, precision = 'float64'):
 
-        """Standard __init__ method.
+        """Standard __init__ method. Does not create any widget.
         
         Parameters
         ----------
@@ -29,196 +442,1229 @@ class Combcol:
             image array
         colors : list of str
             list of colors to use a colormap for each channel
+        profile : bool
+            record per-stage timings and allocation sizes of renders and exports
+        precision : str
+            working precision of the compositing
+            'float64': float64 arithmetic, combine returns float64 RGBA (reference)
+            'float32': a float64 image is stored as float32 and combine works in float32,
+                integer frames included, and returns float32 RGBA (half the memory).
+                Integer images give the reference values; float values differ from the
+                reference by float32 rounding (< 1e-7) except where rounding moves a
+                pixel across an 8-bit level, which changes it by one level of the
+                first rescale, i.e. at most 1/(hi - lo) after a contrast window (lo, hi)
+            'uint8': image stored as float32 as above, combine returns uint8 RGBA
+                built with fused 8-bit LUTs (one eighth of the float64 memory).
+                For integer images the result is 255 * reference truncated, so
+                0 <= reference - result/255 < 1/255; float images add the 'float32' error
         
         Attributes
         ----------
             
         colormaps = dict
-            dictionary of matplotlib ListedColormap
+            dictionary of LUT (matplotlib ListedColormap also accepted)
+        hist_cache = dict
+            per-frame bincounts of each channel in the 0-255 contrast range (keyed by t)
+            and in the adaptive intensity bins (keyed by (t, nbins))
+        intensity_range = tuple
+            global (low, high) intensity percentiles of the dataset used for adaptive bins
+        preview_cache = dict
+            rescaled uint8 frames used by montage, keyed by (step, downscale)
+        view_cache = dict
+            rescaled uint8 data of the time projection and kymograph views
+        raw_image = numpy array
+            unprocessed image; image holds the preprocessed stack when set_preprocessing is used
+        preprocessing = list
+            per-channel preprocessing settings currently applied to image
+        stats = dict
+            per-stage timings and allocation sizes, filled when profile is True
+        plans = dict
+            RenderPlan objects keyed by (frame shape, dtype name, blend mode)
         
         """
         
+        if precision not in PRECISIONS:
+            raise ValueError('precision must be one of '+', '.join(PRECISIONS))
+        self.precision = precision
+        if precision != 'float64' and isinstance(image, np.ndarray) and image.dtype == np.float64:
+            image = image.astype(np.float32)
+        
         self.image = image
+        self.raw_image = image
+        self.preprocessing = None
         self.colors = colors
+        self.hist_cache = {}
+        self.preview_cache = {}
+        self.view_cache = {}
+        self.intensity_range = None
+        self.plans = {}
+        
+        self.profile = profile
+        self.stats = {}
         
         self.selected_contrast = [(0.0, 255.0) for i in range(3)]
         self.selected_colors = ['Red', 'Green', 'Blue']
         
-        self.possible_colors = ['Red','Green','Blue','Cyan','Magenta']
-        self.color_select = [ipw.Select(options = self.possible_colors, 
-                                        value = self.possible_colors[i],
-                                        rows = 8,
-                                        layout={'width': '300px'}) for i in range(3)]
-        
         self.def_colormaps()
         
-        self.hist_button = ipw.Button(description = 'Create movie')
-        self.hist_button.on_click(self.button_callback)
-        self.out_movie = ipw.Output()
-        
-        self.colorpick = ipw.ColorPicker(description='Pick a color',style = {'description_width': '150px'})
-        self.createLUT_button = ipw.Button(description = 'Create colormap',layout={'width': '300px'})
-        self.createLUT_button.on_click(self.createLUT)
-        self.colorname = ipw.Text(description='Name the color', style = {'description_width': '150px'})
-        
        
     def def_colormaps(self):
-        '''Generate color maps'''
+        '''Generate color maps (the default LUTs are built once and shared by all instances)'''
+        
+        if Compositor._default_colormaps is None:
+            colormaps = {}
+            custom_map = None
+            
+            custom_map = LUT(np.c_[np.linspace(0,1,256),np.zeros(256),np.zeros(256)])
+            colormaps['Red'] = custom_map
+            
+            custom_map = LUT(np.c_[np.zeros(256),np.linspace(0,1,256),np.zeros(256)])
+            colormaps['Green'] = custom_map
+            
+            custom_map = LUT(np.c_[np.zeros(256),np.zeros(256),np.linspace(0,1,256)])
+            colormaps['Blue'] = custom_map
+            
+            custom_map = LUT(np.c_[np.zeros(256),np.linspace(0,1,256),np.linspace(0,1,256)])
+            colormaps['Cyan'] = custom_map
+            
+            custom_map = LUT(np.c_[np.linspace(0,1,256),np.zeros(256),np.linspace(0,1,256)])
+            colormaps['Magenta'] = custom_map
+            
+            Compositor._default_colormaps = colormaps
         
-        self.colormaps = {}
-        custom_map = None
+        self.colormaps = dict(Compositor._default_colormaps)
         
-        custom_map = ListedColormap(np.c_[np.linspace(0,1,256),np.zeros(256),np.zeros(256)])
-        self.colormaps['Red'] = custom_map
         
-        custom_map = ListedColormap(np.c_[np.zeros(256),np.linspace(0,1,256),np.zeros(256)])
-        self.colormaps['Green'] = custom_map
+    def add_colormap(self, color, name = None):
+        '''Add a linear colormap from black to color (hex string or RGB in [0, 1]) and return its name'''
         
-        custom_map = ListedColormap(np.c_[np.zeros(256),np.zeros(256),np.linspace(0,1,256)])
-        self.colormaps['Blue'] = custom_map
+        if isinstance(color, str):
+            color = np.array(list(int(color[i:i+2], 16) for i in (1, 3, 5)))/255
+        new_col_scale = np.c_[np.linspace(0,color[0],256),np.linspace(0,color[1],256),np.linspace(0,color[2],256)]
+        if not name:
+            name = 'New col'+str(len(self.colormaps)-4)
+        self.colormaps[name] = LUT(new_col_scale)
+        #plans may hold a LUT of a replaced colormap of the same name
+        self.plans = {}
+        return name
         
-        custom_map = ListedColormap(np.c_[np.zeros(256),np.linspace(0,1,256),np.linspace(0,1,256)])
-        self.colormaps['Cyan'] = custom_map
         
-        custom_map = ListedColormap(np.c_[np.linspace(0,1,256),np.zeros(256),np.linspace(0,1,256)])
-        self.colormaps['Magenta'] = custom_map
+    def _tic(self):
+        '''Start timing a stage if profiling is enabled'''
+        
+        if self.profile:
+            return time.perf_counter()
+        return None
+    
+    
+    def _toc(self, stage, t0, *arrays):
+        '''Record the duration of a stage and the size of the arrays it allocated'''
+        
+        if t0 is None:
+            return
+        duration = time.perf_counter() - t0
+        nbytes = sum(getattr(a, 'nbytes', 0) for a in arrays)
+        entry = self.stats.setdefault(stage, {'calls': 0, 'total_s': 0.0, 'max_s': 0.0, 'bytes': 0})
+        entry['calls'] += 1
+        entry['total_s'] += duration
+        entry['max_s'] = max(entry['max_s'], duration)
+        entry['bytes'] += nbytes
+    
+    
+    def get_stats(self):
+        '''Return per-stage call counts, total, mean and max times and allocated bytes'''
+        
+        return {stage: {**entry, 'mean_s': entry['total_s']/entry['calls']}
+                for stage, entry in self.stats.items()}
+    
+    
+    def reset_stats(self):
+        '''Clear the recorded timings'''
         
+        self.stats = {}
+    
+    
+    def stats_html(self):
+        '''Format the recorded timings as an HTML table'''
         
+        rows = ''.join('<tr><td>{}</td><td>{}</td><td>{:.2f}</td><td>{:.2f}</td><td>{:.1f}</td></tr>'.format(
+            stage, entry['calls'], 1000*entry['mean_s'], 1000*entry['max_s'], entry['bytes']/entry['calls']/1e6)
+                       for stage, entry in self.get_stats().items())
+        header = '<tr><th>stage</th><th>calls</th><th>mean (ms)</th><th>max (ms)</th><th>MB/call</th></tr>'
+        return '<table>' + header + rows + '</table>'
+    
+    
     def combine(self, images, colors = None, contrast = None):
-        '''Combine up to three images in a maximum projection RGB image'''
+        '''Combine up to three images in a maximum projection RGB image
+        
+        The RGBA result is float in [0, 1] or uint8 in [0, 255] depending on precision.'''
         
         if colors is None:
             colors = self.selected_colors
         if contrast is None:
             contrast = self.selected_contrast
+        
+        if self.precision == 'uint8':
+            im_combined = np.empty(images.shape[1:3] + (4,), dtype = np.uint8)
+            im_combined[:,:,3] = 255
+            plan = self.render_plan(images.shape, images.dtype, colors = colors, contrast = contrast)
+            plan.render(images, out = im_combined[:,:,0:3])
+            return im_combined
+        
+        work = self.float_dtype()
+        images = self.working_array(images)
             
-        images = skimage.exposure.rescale_intensity(images, out_range = np.uint8).astype(np.uint8)
-        rescaled_images = [skimage.exposure.rescale_intensity(images[i,:,:], in_range = contrast[i], out_range = np.uint8) for i in range(images.shape[0])]
-                                   
-        colored_images = [self.colormaps[colors[ind]](im) for ind, im in enumerate(rescaled_images)]
+        t0 = self._tic()
+        images = rescale_uint8(images)
+        self._toc('rescale', t0, images)
+        
+        t0 = self._tic()
+        dtype = None if work == np.float64 else work
+        rescaled_images = [rescale_uint8(images[i,:,:], in_range = contrast[i], dtype = dtype) for i in range(images.shape[0])]
+        self._toc('rescale', t0, *rescaled_images)
         
-        im_combined = np.max(np.stack(colored_images,axis = 3),axis = 3)
+        #maximum of the colored channels, accumulated in place
+        t0 = self._tic()
+        im_combined = np.take(self.lut_table(colors[0], work), rescaled_images[0], axis = 0)
+        for ind in range(1, len(rescaled_images)):
+            np.maximum(im_combined, np.take(self.lut_table(colors[ind], work), rescaled_images[ind], axis = 0), out = im_combined)
+        self._toc('colormap', t0, im_combined)
         
         return im_combined
     
     
-    def interactive_colors(self):
-        '''Create an interactive GUI to set colors and contrast'''
+    def composite_stack(self, colors = None, contrast = None):
+        '''Combine every time point into a uint8 RGB stack of shape (T, Y, X, 3)'''
         
-        #define three sliders for contrast
-        contrast = [ipw.FloatRangeSlider(min=0,max = 255, step=1, value = (0,255),layout={'width': '300px'}) for i in range(3)]
+        plan = self.render_plan(colors = colors, contrast = contrast)
+        out = np.empty((self.image.shape[0],) + self.image.shape[2:4] + (3,), dtype = np.uint8)
+        for t in range(self.image.shape[0]):
+            plan.render(self.image[t], out = out[t])
+        return out
+    
+    
+    def iter_frames(self, stride = 1, downscale = 1, colors = None, contrast = None):
+        '''Yield uint8 RGB composites of every stride-th time point
         
-        #define time slider
-        time_slider = ipw.IntSlider(min=0, max = self.image.shape[0]-1, value = 0, description = 'Time')
+        Frames are subsampled by downscale along X and Y before compositing,
+        so the intensity normalisation uses the subsampled pixels.'''
         
-        #define plotting function that automatically updates with widgets
-        def f(c0, c1, c2, t, col0, col1, col2, im):
+        nchan, ny, nx = self.image.shape[1:4]
+        plan = self.render_plan((nchan, -(-ny//downscale), -(-nx//downscale)), colors = colors, contrast = contrast)
+        for t in range(0, self.image.shape[0], stride):
+            t0 = self._tic()
+            im_time = self.image[t,:,::downscale,::downscale]
+            self._toc('slice', t0, im_time)
+            yield plan.render(im_time).copy()
+    
+    
+    def export_movie(self, movie_name = 'movie.gif', fps = 10, stride = 1, downscale = 1,
+                     colors = None, contrast = None):
+        '''Stream composited frames one by one into an imageio writer
+        
+        The format is chosen from the extension of movie_name: .gif, .png/.apng
+        (animated PNG), .tif/.tiff, .webm or .mp4 (the last two need imageio-ffmpeg).
+        Only one composited frame is held in memory at a time; TIFF and FFmpeg
+        encode each frame immediately while the Pillow based GIF/APNG writers keep
+        the 8-bit frames until the file is closed, which stride and downscale keep small.'''
+        
+        import imageio
+        
+        ext = os.path.splitext(movie_name)[1].lower()
+        if ext in ['.gif', '.png', '.apng']:
+            kwargs = {'duration': 1000/fps, 'loop': 0}
+        elif ext in ['.tif', '.tiff']:
+            kwargs = {'contiguous': True}
+        elif ext == '.webm':
+            kwargs = {'format': 'FFMPEG', 'fps': fps, 'codec': 'libvpx-vp9', 'macro_block_size': 1}
+        elif ext == '.mp4':
+            kwargs = {'format': 'FFMPEG', 'fps': fps, 'codec': 'libx264', 'macro_block_size': 1}
+        else:
+            raise ValueError('Unsupported movie format: '+ext)
+        if kwargs.get('format') == 'FFMPEG':
+            try:
+                import imageio_ffmpeg
+            except ImportError:
+                raise ImportError(ext+' export requires the imageio-ffmpeg package '
+                                  '(pip install imageio-ffmpeg or conda install -c conda-forge imageio-ffmpeg)')
+        
+        with imageio.get_writer(movie_name, **kwargs) as writer:
+            for frame in self.iter_frames(stride = stride, downscale = downscale, colors = colors, contrast = contrast):
+                t0 = self._tic()
+                writer.append_data(frame)
+                self._toc('encode', t0, frame)
+        return movie_name
+    
+    
+    def clear_caches(self):
+        '''Forget all data derived from image (histograms, previews, views)'''
+        
+        self.hist_cache = {}
+        self.preview_cache = {}
+        self.view_cache = {}
+        self.intensity_range = None
+    
+    
+    def preprocess_channel(self, images, settings):
+        '''Apply background subtraction then filtering to a (T, Y, X) block of one channel
+        
+        settings is a dict with optional keys:
+            background : None, a number subtracted from all pixels, or 'percentile'
+                to subtract the per-frame percentile given by 'percentile' (default 5)
+            filter : None, 'gaussian' (width 'sigma', default 1) or 'median' (size 'size', default 3)
+        Values below zero after background subtraction are set to zero.'''
+        
+        from scipy import ndimage
+        
+        background = settings.get('background')
+        if background is not None:
+            if background == 'percentile':
+                background = np.percentile(images, settings.get('percentile', 5), axis = (1,2), keepdims = True)
+            images = np.clip(images - np.asarray(background, dtype = images.dtype), 0, None)
+        
+        filt = settings.get('filter')
+        if filt == 'gaussian':
+            sigma = settings.get('sigma', 1)
+            images = ndimage.gaussian_filter(images, sigma = (0, sigma, sigma))
+        elif filt == 'median':
+            size = settings.get('size', 3)
+            images = ndimage.median_filter(images, size = (1, size, size))
+        elif filt is not None:
+            raise ValueError('Unknown filter: '+str(filt))
+        return images
+    
+    
+    def set_preprocessing(self, settings, chunk = 16, workers = 4):
+        '''Preprocess each channel of raw_image and use the result as image
+        
+        settings is a list with one dict (see preprocess_channel) or None per channel, or
+        None to go back to the raw image. Filtering is done in the working float type of
+        the precision, on blocks of chunk time points on a thread pool. The result is kept until the settings change, so rendering, sliders
+        and exports never recompute the filters.'''
+        
+        if settings is None or all(s is None for s in settings):
+            settings = None
+        if settings == self.preprocessing:
+            return self.image
+        
+        if settings is None:
+            self.image = self.raw_image
+        else:
+            t0 = self._tic()
+            raw = self.raw_image
+            out = np.empty(raw.shape, dtype = self.float_dtype())
+            jobs = [(c, slice(t, t + chunk)) for c in range(raw.shape[1]) for t in range(0, raw.shape[0], chunk)]
             
-            self.selected_colors = [col0, col1, col2]
-            self.selected_contrast = [c0,c1,c2]
-
-            im_time = im[t,:,:,:].copy()            
-            im_combined = self.combine(im_time, colors = self.selected_colors, contrast = self.selected_contrast)
-
-            plt.figure(figsize=(4,4))
-            plt.imshow(im_combined)
-
-        #create dictionary of widgets 'ui_widgets' needed for interactive_output()   
-        ui_contrast = {'c'+str(ind): x for ind, x in enumerate(contrast)}
-        ui_time = {'t':time_slider}
-        ui_im ={'im' : ipw.fixed(self.image)}
-        ui_col = {'col'+str(ind): x for ind, x in enumerate(self.color_select)}
-        ui_widgets = {**ui_contrast, **ui_time, **ui_col, **ui_im}
-
-        #create a wideget container 'ui' for widget rendering
-        children = [ipw.VBox([ipw.HTML('Channel '+str(ind)), contrast[ind], self.color_select[ind]]) for ind in range(3)]
-        tab = ipw.Tab()
-        tab.children = children
-        for i in range(len(children)):
-            tab.set_title(i, 'Channel '+str(i))
+            def run(job):
+                c, sl = job
+                block = raw[sl,c].astype(out.dtype)
+                if c < len(settings) and settings[c] is not None:
+                    block = self.preprocess_channel(block, settings[c])
+                out[sl,c] = block
+            
+            for _ in _ordered_map(run, jobs, workers):
+                pass
+            self.image = out
+            self._toc('preprocess', t0, out)
         
-        ui = ipw.HBox([tab, ipw.VBox([self.colorpick, self.colorname, self.createLUT_button])])
-        #ui = ipw.VBox([time_slider, tab_col])
-
-        #connecte rendering function with widets
-        out = ipw.interactive_output(f, ui_widgets)
-
-        #display widgets (ui) and plot (out)
-        display(ipw.HBox([ipw.VBox([out,time_slider]), ui]))
+        self.preprocessing = None if settings is None else [None if s is None else dict(s) for s in settings]
+        self.clear_caches()
+        return self.image
+    
+    
+    def rescale_frames(self, images):
+        '''Rescale each frame of a (N, C, Y, X) stack to uint8 like combine does, in one vectorized pass
+        
+        As in combine, float64 stacks are processed in the working float type of the precision.'''
+        
+        images = self.working_array(images)
+        work = images.dtype if np.issubdtype(images.dtype, np.floating) else np.float64
+        imin = images.min(axis = (1,2,3), keepdims = True).astype(work)
+        imax = images.max(axis = (1,2,3), keepdims = True).astype(work)
+        span = imax.astype(np.float64) - imin.astype(np.float64)
+        divisor = np.where(span != 0, span, 1).astype(work)
+        
+        out = np.clip(images, imin, imax)
+        out -= imin
+        out /= divisor
+        out *= 255.0
+        out = out.astype(np.uint8)
+        constant = np.ravel(span == 0)
+        if np.any(constant):
+            out[constant] = np.clip(images[constant], 0, 255).astype(np.uint8)
+        return out
+    
+    
+    def float_dtype(self):
+        '''Float type used for intermediate arrays at the current precision'''
+        
+        return np.float64 if self.precision == 'float64' else np.float32
+    
+    
+    def working_array(self, images):
+        '''Cast images to the float type their rescale is done in at the current precision
+        
+        float64 data is processed in float_dtype(); integer data in float64 at 'float64'
+        precision and in float32 otherwise, so that the reduced modes never allocate
+        float64 frames. Other arrays are returned unchanged.'''
+        
+        if images.dtype == np.float64 or np.issubdtype(images.dtype, np.integer):
+            return images.astype(self.float_dtype(), copy = False)
+        return images
+    
+    
+    def lut_dtype(self):
+        '''Float type of the fused LUT arithmetic, matching the colormap step of combine'''
+        
+        return np.float32 if self.precision == 'float32' else np.float64
+    
+    
+    def lut_table(self, color, dtype = np.float64):
+        '''(256, 4) RGBA table of a colormap for 8-bit indices'''
+        
+        return np.asarray(self.colormaps[color](np.arange(256, dtype = np.uint8)), dtype = dtype)
+    
+    
+    def to_rgb8(self, im_combined):
+        '''Convert a combine result to a uint8 RGB image'''
+        
+        if im_combined.dtype == np.uint8:
+            return im_combined[:,:,0:3]
+        return (255 * im_combined[:,:,0:3]).astype(np.uint8)
+    
+    
+    def channel_lut(self, color, contrast, dtype = np.float64):
+        '''Fuse the contrast window and colormap of a channel into a (256, 3) uint8 lookup table
+        
+        dtype is the float type of the contrast and color arithmetic.'''
+        
+        levels = rescale_uint8(np.arange(256, dtype = np.uint8), in_range = contrast, dtype = dtype)
+        return (255 * self.lut_table(color, dtype)[levels,0:3]).astype(np.uint8)
+    
+    
+    def render_plan(self, shape = None, dtype = None, colors = None, contrast = None, blend = 'max'):
+        '''Return a RenderPlan for (C, Y, X) frames of the given shape and dtype (default: those of image)
+        
+        Plans are kept in plans and reused for the same shape, dtype and blend mode;
+        a reused plan only rebuilds the LUTs of channels whose color or contrast changed.'''
+        
+        if shape is None:
+            shape = self.image.shape[1:]
+        if dtype is None:
+            dtype = self.image.dtype
+        if colors is None:
+            colors = self.selected_colors
+        if contrast is None:
+            contrast = self.selected_contrast
+        
+        key = (tuple(shape), np.dtype(dtype).name, blend)
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = RenderPlan(self, shape, dtype, colors, contrast, blend = blend)
+            self.plans[key] = plan
+        else:
+            plan.update(colors, contrast)
+        return plan
+    
+    
+    def preview_frames(self, step = 1, downscale = 1):
+        '''Return the cached uint8 frames of every step-th time point, subsampled by downscale'''
+        
+        key = (step, downscale)
+        if key not in self.preview_cache:
+            t0 = self._tic()
+            self.preview_cache[key] = self.rescale_frames(self.image[::step,:,::downscale,::downscale])
+            self._toc('rescale', t0, self.preview_cache[key])
+        return self.preview_cache[key]
+    
+    
+    def montage(self, step = 1, ncols = None, downscale = 1, colors = None, contrast = None):
+        '''Tile the composites of every step-th time point into one uint8 RGB mosaic
+        
+        Each channel is mapped through its fused contrast/color LUT for all tiles at
+        once and max-combined directly into the preallocated mosaic.'''
+        
+        if colors is None:
+            colors = self.selected_colors
+        if contrast is None:
+            contrast = self.selected_contrast
+        
+        frames = self.preview_frames(step = step, downscale = downscale)
+        n, nchan, ny, nx = frames.shape
+        if ncols is None:
+            ncols = int(np.ceil(np.sqrt(n)))
+        nrows = int(np.ceil(n / ncols))
+        nfull = n // ncols
+        
+        t0 = self._tic()
+        mosaic = np.zeros((nrows*ny, ncols*nx, 3), dtype = np.uint8)
+        #(row, column, y, x, rgb) view on the mosaic
+        tiles = mosaic.reshape(nrows, ny, ncols, nx, 3).transpose(0,2,1,3,4)
+        for c in range(nchan):
+            lut = self.channel_lut(colors[c], contrast[c], dtype = self.lut_dtype())
+            if nfull > 0:
+                colored = np.take(lut, frames[0:nfull*ncols,c], axis = 0).reshape(nfull, ncols, ny, nx, 3)
+                np.maximum(tiles[0:nfull], colored, out = tiles[0:nfull])
+            if nfull*ncols < n:
+                np.maximum(tiles[nfull,0:n-nfull*ncols], np.take(lut, frames[nfull*ncols:,c], axis = 0), out = tiles[nfull,0:n-nfull*ncols])
+        self._toc('montage', t0, mosaic)
+        return mosaic
+    
+    
+    def combine_tiled(self, images, filename = None, out = None, tile_size = 1024, workers = 4,
+                      colors = None, contrast = None, in_range = None):
+        '''Combine a (C, Y, X) image too large for memory tile by tile into a uint8 RGB image
+        
+        images can be any array supporting slicing (numpy memmap, zarr, h5py, ...). The
+        result is streamed into a tiled BigTIFF if filename is given (requires tifffile
+        and a tile_size multiple of 16),
+        else written into out, an array-like of shape (Y, X, 3) (numpy array by default).
+        Tiles are processed in parallel threads and peak memory is a small multiple of
+        tile_size**2 * C * 8 bytes * 2 * workers. The global intensity range used by
+        combine is taken from in_range or computed in a first streaming pass; the result
+        equals to_rgb8(combine(images)).'''
+        
+        if colors is None:
+            colors = self.selected_colors
+        if contrast is None:
+            contrast = self.selected_contrast
+        
+        if filename is not None and tile_size % 16 != 0:
+            raise ValueError('tile_size must be a multiple of 16 for TIFF tiles')
+        
+        nchan = images.shape[0]
+        shape = images.shape[1:3]
+        tiles = tile_slices(shape, tile_size)
+        
+        def load(sl):
+            #float64 data is processed in the working float type, as in combine
+            return self.working_array(np.asarray(images[:,sl[0],sl[1]]))
+        
+        def tile_range(sl):
+            tile = load(sl)
+            return tile.min(), tile.max()
+        
+        if in_range is None:
+            t0 = self._tic()
+            ranges = list(_ordered_map(tile_range, tiles, workers))
+            in_range = (min(r[0] for r in ranges), max(r[1] for r in ranges))
+            self._toc('tile_range', t0)
+        
+        luts = [self.channel_lut(colors[c], contrast[c], dtype = self.lut_dtype()) for c in range(nchan)]
+        
+        def render_tile(sl):
+            t0 = self._tic()
+            tile = rescale_uint8(load(sl), in_range = in_range)
+            rgb = np.take(luts[0], tile[0], axis = 0)
+            for c in range(1, nchan):
+                np.maximum(rgb, np.take(luts[c], tile[c], axis = 0), out = rgb)
+            self._toc('tile', t0, tile, rgb)
+            return sl, rgb
+        
+        if filename is not None:
+            import tifffile
+            tifffile.imwrite(filename, (rgb for _, rgb in _ordered_map(render_tile, tiles, workers)),
+                             shape = shape + (3,), dtype = np.uint8, tile = (tile_size, tile_size),
+                             bigtiff = True, photometric = 'rgb')
+            return filename
+        
+        if out is None:
+            out = np.empty(shape + (3,), dtype = np.uint8)
+        for sl, rgb in _ordered_map(render_tile, tiles, workers):
+            out[sl[0],sl[1]] = rgb
+        return out
+    
+    
+    def combine_batch(self, frames, colors = None, contrast = None):
+        '''Combine a batch of (C, Y, X) frames of equal shape in one vectorized call
+        
+        frames is a (N, C, Y, X) array; returns a (N, Y, X, 3) uint8 RGB stack equal to
+        to_rgb8(combine(frame)) for each frame.'''
+        
+        t0 = self._tic()
+        rescaled = self.rescale_frames(frames)
+        self._toc('rescale', t0, rescaled)
+        return self.apply_luts(rescaled.transpose(1,0,2,3), colors = colors, contrast = contrast)
+    
+    
+    def apply_luts(self, rescaled, colors = None, contrast = None, out = None):
+        '''Composite rescaled uint8 channels (C, ...) into a uint8 RGB image (..., 3) with the fused LUTs'''
+        
+        if colors is None:
+            colors = self.selected_colors
+        if contrast is None:
+            contrast = self.selected_contrast
+        
+        t0 = self._tic()
+        luts = [self.channel_lut(colors[c], contrast[c], dtype = self.lut_dtype()) for c in range(rescaled.shape[0])]
+        if out is None:
+            rgb = np.take(luts[0], rescaled[0], axis = 0)
+        else:
+            rgb = out
+            np.take(luts[0], rescaled[0], axis = 0, out = rgb)
+        for c in range(1, rescaled.shape[0]):
+            np.maximum(rgb, np.take(luts[c], rescaled[c], axis = 0), out = rgb)
+        self._toc('colormap', t0, rgb)
+        return rgb
+    
+    
+    def time_projection(self, colors = None, contrast = None):
+        '''Composite of the maximum projection over time as a uint8 RGB image
+        
+        The rescaled projection is cached, so changing colors or contrast only reapplies the LUTs.'''
+        
+        if 'projection' not in self.view_cache:
+            t0 = self._tic()
+            if isinstance(self.image, np.ndarray):
+                proj = np.max(self.image, axis = 0)
+            else:
+                #running maximum so that disk sources are read frame by frame
+                proj = np.array(self.image[0])
+                for t in range(1, self.image.shape[0]):
+                    np.maximum(proj, self.image[t], out = proj)
+            self.view_cache['projection'] = self.rescale_frames(proj[np.newaxis])[0]
+            self._toc('projection', t0, proj)
+        return self.apply_luts(self.view_cache['projection'], colors = colors, contrast = contrast)
+    
+    
+    def line_coordinates(self, start, end, width = 1):
+        '''Sampling coordinates of a line from start (y, x) to end (y, x), one point per pixel length
+        
+        Returns y and x arrays of shape (width, N); the width parallel lines are averaged by kymograph.'''
+        
+        start = np.asarray(start, dtype = np.float64)
+        end = np.asarray(end, dtype = np.float64)
+        length = np.hypot(*(end - start))
+        npoints = int(np.ceil(length)) + 1
+        steps = np.linspace(0, 1, npoints)
+        coords = start[:,np.newaxis] + steps[np.newaxis,:] * (end - start)[:,np.newaxis]
+        
+        normal = np.array([-(end - start)[1], (end - start)[0]]) / max(length, 1e-12)
+        offsets = np.arange(width) - (width - 1) / 2
+        coords = coords[:,np.newaxis,:] + normal[:,np.newaxis,np.newaxis] * offsets[np.newaxis,:,np.newaxis]
+        return coords[0], coords[1]
+    
+    
+    def kymograph(self, start, end, width = 1, colors = None, contrast = None):
+        '''Composite kymograph (time x position) along a line as a uint8 RGB image
+        
+        The stack is sampled once for all time points and channels with bilinear interpolation
+        at precomputed coordinates; the rescaled result is cached per line.'''
+        
+        key = ('kymograph', tuple(start), tuple(end), width)
+        if key not in self.view_cache:
+            t0 = self._tic()
+            ny, nx = self.image.shape[2:4]
+            yy, xx = self.line_coordinates(start, end, width = width)
+            yy = np.clip(yy, 0, ny - 1)
+            xx = np.clip(xx, 0, nx - 1)
+            y0 = np.minimum(np.floor(yy).astype(np.intp), ny - 2) if ny > 1 else np.zeros(yy.shape, np.intp)
+            x0 = np.minimum(np.floor(xx).astype(np.intp), nx - 2) if nx > 1 else np.zeros(xx.shape, np.intp)
+            work = self.image.dtype if np.issubdtype(self.image.dtype, np.floating) else self.float_dtype()
+            wy = (yy - y0).astype(work)
+            wx = (xx - x0).astype(work)
+            y1 = np.minimum(y0 + 1, ny - 1)
+            x1 = np.minimum(x0 + 1, nx - 1)
+            
+            def sample(im):
+                #(T, C, width, N) samples, averaged over the line width
+                values = (im[:,:,y0,x0] * ((1 - wy) * (1 - wx)) + im[:,:,y0,x1] * ((1 - wy) * wx)
+                          + im[:,:,y1,x0] * (wy * (1 - wx)) + im[:,:,y1,x1] * (wy * wx))
+                return values.mean(axis = 2)
+            
+            if isinstance(self.image, np.ndarray):
+                values = sample(self.image)
+            else:
+                values = np.concatenate([sample(self.image[t][np.newaxis]) for t in range(self.image.shape[0])])
+            #channels first: (1, C, T, N)
+            self.view_cache[key] = self.rescale_frames(values.transpose(1,0,2)[np.newaxis])[0]
+            self._toc('kymograph', t0, values)
+        return self.apply_luts(self.view_cache[key], colors = colors, contrast = contrast)
+    
+    
+    def frame_histogram(self, t):
+        '''Return cached per-channel bincounts of frame t in the 0-255 contrast range'''
+        
+        if t not in self.hist_cache:
+            t0 = self._tic()
+            im_time = rescale_uint8(self.image[t,::])
+            self.hist_cache[t] = np.stack([np.bincount(np.ravel(im_time[c,:,:]), minlength = 256)
+                                           for c in range(im_time.shape[0])])
+            self._toc('histogram', t0, im_time, self.hist_cache[t])
+        return self.hist_cache[t]
+    
+    
+    def intensity_index(self, low = 0.1, high = 99.9, max_frames = 16, max_samples = 1000000):
+        '''Global (low, high) intensity percentiles of the dataset, computed once
+        
+        The percentiles are estimated from at most max_frames evenly spaced time points,
+        subsampled to about max_samples pixels in total.'''
+        
+        if self.intensity_range is None:
+            t0 = self._tic()
+            nframes = self.image.shape[0]
+            times = range(0, nframes, max(1, int(np.ceil(nframes / max_frames))))
+            pixels = int(np.prod(self.image.shape[1:]))
+            step = max(1, pixels * len(times) // max_samples)
+            sample = np.concatenate([np.ravel(self.image[t])[::step] for t in times])
+            self.intensity_range = tuple(float(x) for x in np.percentile(sample, [low, high]))
+            self._toc('intensity_index', t0, sample)
+        return self.intensity_range
+    
+    
+    def histogram_bins(self, nbins = 80):
+        '''Bin edges shared by all frames, spanning the global intensity percentiles
+        
+        For integer images the bin width is a whole number of intensity levels and only
+        as many bins as needed to cover the range are returned (at most nbins), so that
+        e.g. 8-bit data does not end with empty bins past the percentile range.'''
+        
+        lo, hi = self.intensity_index()
+        if np.issubdtype(self.image.dtype, np.integer):
+            lo = np.floor(lo)
+            width = max(1.0, np.ceil((hi - lo + 1) / nbins))
+            nbins = int(np.ceil((np.floor(hi) - lo + 1) / width))
+        else:
+            width = (hi - lo) / nbins if hi > lo else 1.0
+        return lo + width * np.arange(nbins + 1)
+    
+    
+    def intensity_histogram(self, t, bins = None):
+        '''Per-channel histogram of the raw intensities of frame t
+        
+        bins is None (80 adaptive bins), a number of adaptive bins or explicit bin edges.
+        Adaptive histograms are built with integer bincounts (over the intensity levels for
+        8 and 16-bit images, over the bin indices otherwise) and cached;
+        values outside the bin range are counted in the first or last bin.
+        Returns counts of shape (C, number of bins) and the bin edges.'''
+        
+        if bins is not None and np.ndim(bins) > 0:
+            frame = self.image[t,::]
+            return np.stack([np.histogram(frame[c], bins = bins)[0] for c in range(frame.shape[0])]), np.asarray(bins)
+        
+        key = (t, 80 if bins is None else int(bins))
+        edges = self.histogram_bins(key[1])
+        nbins = len(edges) - 1
+        if key not in self.hist_cache:
+            t0 = self._tic()
+            frame = self.image[t,::]
+            nchan = frame.shape[0]
+            width = edges[1] - edges[0]
+            if np.issubdtype(frame.dtype, np.unsignedinteger) and frame.dtype.itemsize <= 2:
+                #count each intensity level, then sum the levels of each bin from the cumulative counts;
+                #the first and last bins also receive the levels below and above the range
+                nlevels = np.iinfo(frame.dtype).max + 1
+                bin_ends = np.clip(edges[1:].astype(np.intp), 0, nlevels)
+                bin_ends[-1] = nlevels
+                cumulative = np.stack([np.cumsum(np.bincount(np.ravel(frame[c]), minlength = nlevels))
+                                       for c in range(nchan)])
+                cumulative = np.concatenate([np.zeros((nchan, 1), dtype = cumulative.dtype), cumulative], axis = 1)
+                counts = np.diff(cumulative[:,bin_ends], axis = 1, prepend = 0)
+            else:
+                index = np.clip(((frame - edges[0]) * (1 / width)).astype(np.intp), 0, nbins - 1)
+                index += nbins * np.arange(nchan).reshape(nchan, 1, 1)
+                counts = np.bincount(np.ravel(index), minlength = nchan * nbins).reshape(nchan, nbins)
+            self.hist_cache[key] = counts
+            self._toc('histogram', t0, counts)
+        return self.hist_cache[key], edges
+    
+    
+    def plot_histogram(self, ax, t, colors = None, contrast = None):
+        '''Draw the cached histogram of frame t and the contrast windows on ax'''
+        
+        if colors is None:
+            colors = self.selected_colors
+        if contrast is None:
+            contrast = self.selected_contrast
+        
+        counts = self.frame_histogram(t)
+        for c in range(counts.shape[0]):
+            col = self.colormaps[colors[c]].colors[-1]
+            ax.step(np.arange(256), counts[c], where = 'mid', color = col, alpha = 0.8)
+            ax.axvline(contrast[c][0], color = col, linestyle = '--')
+            ax.axvline(contrast[c][1], color = col, linestyle = '--')
+        ax.set_yscale('log')
+        ax.set_xlim(0, 255)
+        ax.set_facecolor((0, 0, 0))
     
     
     def movie_histogram(self):
         '''Create animated figure of image and histogram'''
         
+        import matplotlib.pyplot as plt
+        import matplotlib.animation as animation
+        
         fig, axes = plt.subplots(1,2,figsize = (10,5))
         ims=[]
         for t in range(self.image.shape[0]):
 
             #create multi-channel iamge
-            newim = self.combine(self.image[t,::])
+            t0 = self._tic()
+            im_time = self.image[t,::]
+            self._toc('slice', t0, im_time)
+            newim = self.combine(im_time)
             #show image and histogram
+            t0 = self._tic()
             a1 = axes[0].imshow(newim)
             ims.append([a1])
-            for c in range(2):
-                _,_,a2 = axes[1].hist(np.ravel(self.image[t,c,:,:]),
-                                      color = self.colormaps[self.selected_colors[c]].colors[-1],alpha = 0.5,
-                        bins = np.arange(0,8000,100))
-                ims[-1]+=a2
+            counts, edges = self.intensity_histogram(t)
+            for c in range(counts.shape[0]):
+                a2 = axes[1].stairs(counts[c], edges, fill = True, alpha = 0.5,
+                                    color = self.colormaps[self.selected_colors[c]].colors[-1])
+                ims[-1].append(a2)
             axes[1].set_facecolor((0, 0,0))
             axes[0].set_axis_off()
+            self._toc('figure', t0)
             
         ani = animation.ArtistAnimation(fig, ims, interval=200, blit=True, repeat_delay=1000)
         return ani
     
     
-    def movie_histogram_writer(self, movie_name = 'movie.mp4'):
-        '''Create and save a combined movie with image and histogram'''
+    def movie_histogram_writer(self, movie_name = 'movie.mp4', fps = 15, bins = None):
+        '''Create and save a combined movie with image and histogram (GIF if movie_name ends in .gif, else FFmpeg)
         
-        moviewriter = FFMpegWriter(fps=15)
+        bins is passed to intensity_histogram (adaptive bins by default).'''
+        
+        import matplotlib.pyplot as plt
+        from matplotlib.animation import FFMpegWriter, PillowWriter
+        
+        if movie_name.lower().endswith('.gif'):
+            moviewriter = PillowWriter(fps=fps)
+        else:
+            moviewriter = FFMpegWriter(fps=fps)
         fig, axes = plt.subplots(1,2,figsize = (7,3))
         with moviewriter.saving(fig, movie_name, dpi=100):
-            for t in range(im_proj.shape[0]):
+            for t in range(self.image.shape[0]):
                 
                 axes[1].cla()
                 #create multi-channel iamge
-                newim = self.combine(self.image[t,::])
+                t0 = self._tic()
+                im_time = self.image[t,::]
+                self._toc('slice', t0, im_time)
+                newim = self.combine(im_time)
                 #show image and histogram
+                t0 = self._tic()
                 axes[0].imshow(newim)
-                for c in range(2):
-                    axes[1].hist(np.ravel(self.image[t,c,:,:]),
-                                      color = self.colormaps[self.selected_colors[c]].colors[-1],alpha = 0.5,
-                        bins = np.arange(0,8000,100))
+                counts, edges = self.intensity_histogram(t, bins = bins)
+                for c in range(counts.shape[0]):
+                    axes[1].stairs(counts[c], edges, fill = True, alpha = 0.5,
+                                   color = self.colormaps[self.selected_colors[c]].colors[-1])
                 axes[0].set_axis_off()
+                self._toc('figure', t0)
             
                 #update_figure(i)
+                t0 = self._tic()
                 moviewriter.grab_frame()
-        fig.clf()
-                
-    def button_callback(self, b):
-        '''Call-back for movie creation button'''
+                self._toc('encode', t0)
+        plt.close(fig)
+
+
+class ColorControls:
+    '''Color and contrast widgets shared by the single-dataset and comparison GUIs
+    
+    Mixed into a Compositor, whose colormaps the created colormaps are added to.'''
+    
+    def color_widgets(self):
+        '''Create the color selectors, the colormap creation widgets and the timings readout'''
         
-        ani = self.movie_histogram()
+        import ipywidgets as ipw
         
-        self.out_movie.clear_output()
-        with self.out_movie:
-            display(HTML(ani.to_html5_video()))
-            
-          
+        self.stats_output = ipw.HTML()
+        
+        self.possible_colors = ['Red','Green','Blue','Cyan','Magenta']
+        self.color_select = [ipw.Select(options = self.possible_colors, 
+                                        value = self.possible_colors[i],
+                                        rows = 8,
+                                        layout={'width': '300px'}) for i in range(3)]
+        
+        self.colorpick = ipw.ColorPicker(description='Pick a color',style = {'description_width': '150px'})
+        self.createLUT_button = ipw.Button(description = 'Create colormap',layout={'width': '300px'})
+        self.createLUT_button.on_click(self.createLUT)
+        self.colorname = ipw.Text(description='Name the color', style = {'description_width': '150px'})
+        
+        
+    def reset_stats(self):
+        '''Clear the recorded timings and their readout'''
+        
+        super().reset_stats()
+        self.stats_output.value = ''
+    
+    
+    def channel_controls(self):
+        '''Create the contrast sliders and the color tabs
+        
+        Returns the widgets keyed by the c0-c2 and col0-col2 argument names used by
+        interactive_output and the container displaying them.'''
+        
+        import ipywidgets as ipw
+        
+        #define three sliders for contrast
+        contrast = [ipw.FloatRangeSlider(min=0,max = 255, step=1, value = (0,255),layout={'width': '300px'}) for i in range(3)]
+        
+        #create dictionary of widgets needed for interactive_output()
+        ui_contrast = {'c'+str(ind): x for ind, x in enumerate(contrast)}
+        ui_col = {'col'+str(ind): x for ind, x in enumerate(self.color_select)}
+        
+        #create a wideget container 'ui' for widget rendering
+        children = [ipw.VBox([ipw.HTML('Channel '+str(ind)), contrast[ind], self.color_select[ind]]) for ind in range(3)]
+        tab = ipw.Tab()
+        tab.children = children
+        for i in range(len(children)):
+            tab.set_title(i, 'Channel '+str(i))
+        
+        ui = ipw.HBox([tab, ipw.VBox([self.colorpick, self.colorname, self.createLUT_button])])
+        
+        return {**ui_contrast, **ui_col}, ui
+    
+    
     def createLUT(self, b):
         '''Create a new color scale based on a picked color'''
         
-        chosen_col = np.array(list(int(self.colorpick.value[i:i+2], 16) for i in (1, 3, 5)))/255
-        new_col_scale = np.c_[np.linspace(0,chosen_col[0],256),np.linspace(0,chosen_col[1],256),np.linspace(0,chosen_col[2],256)]
-        new_map = ListedColormap(new_col_scale)
-        if len(self.colorname.value)>0:
-            new_name = self.colorname.value
-        else:
-            new_name = 'New col'+str(len(self.possible_colors)-4)
-        self.colormaps[new_name] = new_map
+        new_name = self.add_colormap(self.colorpick.value, name = self.colorname.value)
         
         self.possible_colors.append(new_name)
         temp_index = [x.index for x in self.color_select]
         for i in range(3):
             self.color_select[i].options = self.possible_colors
             self.color_select[i].index = temp_index[i]
-          
\ No newline at end of file
+
+
+class Combcol(ColorControls, Compositor):
+    
+    def __init__(self, image,
+                colors = ['Red','Green','Blue'], profile = False, precision = 'float64'):
+
+        """Standard __init__ method. Creates the GUI widgets on top of Compositor.
+        
+        Parameters
+        ----------
+        image : numpy array
+            image array
+        colors : list of str
+            list of colors to use a colormap for each channel
+        profile : bool
+            record per-stage timings and allocation sizes of renders and exports
+        precision : str
+            'float64', 'float32' or 'uint8', see Compositor
+        
+        """
+        
+        import ipywidgets as ipw
+        
+        super().__init__(image, colors = colors, profile = profile, precision = precision)
+        
+        self.color_widgets()
+        
+        self.hist_button = ipw.Button(description = 'Create movie')
+        self.hist_button.on_click(self.button_callback)
+        self.out_movie = ipw.Output()
+        
+        self.montage_step = ipw.BoundedIntText(value = 1, min = 1, max = max(1, image.shape[0]),
+                                               description = 'Every Nth frame', style = {'description_width': '150px'})
+        self.montage_button = ipw.Button(description = 'Create montage')
+        self.montage_button.on_click(self.montage_callback)
+        self.out_montage = ipw.Output()
+        
+        #typed line, also updated when a line is drawn on the projection
+        self.kymograph_line = ipw.Text(description = 'Line y0,x0,y1,x1', placeholder = '10, 10, 100, 100',
+                                       style = {'description_width': '150px'})
+        self.kymograph_button = ipw.Button(description = 'Create kymograph')
+        self.kymograph_button.on_click(self.kymograph_callback)
+        self.out_kymograph = ipw.Output()
+        
+        
+    def interactive_colors(self):
+        '''Create an interactive GUI to set colors and contrast'''
+        
+        import ipywidgets as ipw
+        import matplotlib.pyplot as plt
+        from IPython.display import display
+        
+        ui_channels, ui = self.channel_controls()
+        
+        #define time slider
+        time_slider = ipw.IntSlider(min=0, max = self.image.shape[0]-1, value = 0, description = 'Time')
+        
+        #define plotting function that automatically updates with widgets
+        def f(c0, c1, c2, t, col0, col1, col2):
+            
+            self.selected_colors = [col0, col1, col2]
+            self.selected_contrast = [c0,c1,c2]
+
+            t0 = self._tic()
+            im_time = self.image[t,:,:,:].copy()
+            self._toc('slice', t0, im_time)
+            im_combined = self.combine(im_time, colors = self.selected_colors, contrast = self.selected_contrast)
+
+            t0 = self._tic()
+            plt.figure(figsize=(4,4))
+            plt.imshow(im_combined)
+            self._toc('figure', t0)
+            
+            if self.profile:
+                self.stats_output.value = self.stats_html()
+            
+        #histogram panel only redraws lines from the cached bincounts
+        def h(c0, c1, c2, t, col0, col1, col2):
+            
+            fig, ax = plt.subplots(figsize=(4,3))
+            self.plot_histogram(ax, t, colors = [col0, col1, col2], contrast = [c0, c1, c2])
+
+        #create dictionary of widgets 'ui_widgets' needed for interactive_output()   
+        ui_widgets = {**ui_channels, 't': time_slider}
+
+        #connecte rendering function with widets
+        out = ipw.interactive_output(f, ui_widgets)
+        out_hist = ipw.interactive_output(h, ui_widgets)
+
+        #display widgets (ui) and plots (out, out_hist)
+        if self.profile:
+            display(ipw.VBox([ipw.HBox([ipw.VBox([out,time_slider]), out_hist, ui]), self.stats_output]))
+        else:
+            display(ipw.HBox([ipw.VBox([out,time_slider]), out_hist, ui]))
+    
+    
+    def interactive_view(self, tile_size = 128, preview_downscale = 4, delay = 0.3, zoom = 2):
+        '''Create an interactive GUI that streams frames to a FrameView instead of figures
+        
+        Each change renders the full frame, and only the tiles that changed are sent,
+        subsampled by preview_downscale while a control is being moved. Once the
+        controls have been still for delay seconds the previewed tiles are resent
+        at full resolution.'''
+        
+        import ipywidgets as ipw
+        from IPython.display import display
+        
+        ui_channels, ui = self.channel_controls()
+        time_slider = ipw.IntSlider(min=0, max = self.image.shape[0]-1, value = 0, description = 'Time')
+        
+        self.frame_view = FrameView(self.image.shape[2:4], tile_size = tile_size, zoom = zoom)
+        timer = [None]
+        latest = [None]
+        lock = threading.Lock()
+        
+        def render(downscale):
+            self.selected_colors = [ui_channels['col'+str(i)].value for i in range(3)]
+            self.selected_contrast = [ui_channels['c'+str(i)].value for i in range(3)]
+            im_time = self.image[time_slider.value]
+            #a slider change only rebuilds the LUT of its channel
+            with lock:
+                plan = self.render_plan(im_time.shape, im_time.dtype)
+                rgb = plan.render(im_time)
+                self.frame_view.update(rgb, downscale = downscale)
+                latest[0] = rgb.copy() if downscale > 1 else None
+            if self.profile:
+                self.stats_output.value = self.stats_html()
+        
+        def finish():
+            #resend the previewed tiles of the last frame at full resolution
+            with lock:
+                if latest[0] is not None:
+                    self.frame_view.update(latest[0])
+                    latest[0] = None
+        
+        def on_change(change):
+            render(preview_downscale)
+            if preview_downscale > 1:
+                if timer[0] is not None:
+                    timer[0].cancel()
+                timer[0] = threading.Timer(delay, finish)
+                timer[0].start()
+        
+        for widget in list(ui_channels.values()) + [time_slider]:
+            widget.observe(on_change, names = 'value')
+        render(1)
+        
+        if self.profile:
+            display(ipw.VBox([ipw.HBox([ipw.VBox([self.frame_view.widget, time_slider]), ui]), self.stats_output]))
+        else:
+            display(ipw.HBox([ipw.VBox([self.frame_view.widget, time_slider]), ui]))
+    
+    
+    def button_callback(self, b):
+        '''Call-back for movie creation button'''
+        
+        from IPython.display import HTML, display
+        
+        ani = self.movie_histogram()
+        
+        t0 = self._tic()
+        video = ani.to_html5_video()
+        self._toc('encode', t0)
+        
+        self.out_movie.clear_output()
+        with self.out_movie:
+            display(HTML(video))
+            if self.profile:
+                display(HTML(self.stats_html()))
+            
+          
+    def montage_callback(self, b):
+        '''Call-back for montage creation button'''
+        
+        import matplotlib.pyplot as plt
+        
+        mosaic = self.montage(step = self.montage_step.value)
+        
+        self.out_montage.clear_output()
+        with self.out_montage:
+            fig, ax = plt.subplots(figsize = (8,8))
+            ax.imshow(mosaic)
+            ax.set_axis_off()
+            plt.show()
+            
+          
+    def kymograph_callback(self, b):
+        '''Call-back for kymograph button: show the time projection with the line and its kymograph
+        
+        The typed coordinates give the first line. If ipympl is installed the figure is
+        interactive and a new line is drawn by clicking its two ends on the projection.'''
+        
+        import matplotlib.pyplot as plt
+        from IPython.display import display
+        
+        self.out_kymograph.clear_output()
+        with self.out_kymograph:
+            try:
+                y0, x0, y1, x1 = [float(x) for x in self.kymograph_line.value.split(',')]
+            except ValueError:
+                print('Enter the line as y0, x0, y1, x1')
+                return
+            try:
+                from ipympl.backend_nbagg import new_figure_manager_given_figure
+            except ImportError:
+                new_figure_manager_given_figure = None
+            
+            if new_figure_manager_given_figure is None:
+                fig, axes = plt.subplots(1,2,figsize = (10,5))
+            else:
+                #ipympl canvas for this figure only, independent of the notebook backend
+                from matplotlib.figure import Figure
+                fig = Figure(figsize = (10,5))
+                axes = fig.subplots(1,2)
+            axes[0].imshow(self.time_projection())
+            line, = axes[0].plot([x0, x1], [y0, y1], color = 'white')
+            axes[0].set_axis_off()
+            kymo = axes[1].imshow(self.kymograph((y0, x0), (y1, x1)), aspect = 'auto')
+            axes[1].set_xlabel('Position')
+            axes[1].set_ylabel('Time')
+            
+            if new_figure_manager_given_figure is None:
+                plt.show()
+                return
+            
+            clicks = []
+            
+            def on_click(event):
+                if event.inaxes is not axes[0]:
+                    return
+                clicks.append((round(event.ydata), round(event.xdata)))
+                if len(clicks) < 2:
+                    line.set_data([clicks[0][1]], [clicks[0][0]])
+                else:
+                    start, end = clicks
+                    del clicks[:]
+                    self.kymograph_line.value = '{}, {}, {}, {}'.format(*start, *end)
+                    line.set_data([start[1], end[1]], [start[0], end[0]])
+                    kymograph = self.kymograph(start, end)
+                    kymo.set_data(kymograph)
+                    kymo.set_extent((-0.5, kymograph.shape[1] - 0.5, kymograph.shape[0] - 0.5, -0.5))
+                fig.canvas.draw_idle()
+            
+            manager = new_figure_manager_given_figure(id(fig), fig)
+            fig.canvas.mpl_connect('button_press_event', on_click)
+            display(manager.canvas)
+
+
+class Comparison(ColorControls, Compositor):
+    
+    def __init__(self, images, names = None,
+                colors = ['Red','Green','Blue'], profile = False, precision = 'float64'):
+
+        """Standard __init__ method. Side-by-side view of several datasets sharing one
+        time slider and one set of color and contrast controls.
+        
+        Parameters
+        ----------
+        images : list of numpy arrays
+            (T, C, Y, X) image arrays, possibly of different lengths
+        names : list of str
+            titles of the datasets
+        colors : list of str
+            list of colors to use a colormap for each channel
+        profile : bool
+            record per-stage timings and allocation sizes of renders and exports
+        precision : str
+            'float64', 'float32' or 'uint8', see Compositor
+        
+        Attributes
+        ----------
+        
+        compositors = list
+            one Compositor per dataset, sharing the colormaps of this object;
+            the first is this object itself, which holds images[0]
+        
+        """
+        
+        super().__init__(images[0], colors = colors, profile = profile, precision = precision)
+        
+        self.color_widgets()
+        
+        self.names = names if names is not None else ['Dataset '+str(i) for i in range(len(images))]
+        self.compositors = [self] + [Compositor(im, colors = colors, precision = precision) for im in images[1:]]
+        for comp in self.compositors[1:]:
+            comp.colormaps = self.colormaps
+        
+        
+    def combine_all(self, t, colors = None, contrast = None):
+        '''Composite time point t of every dataset (clamped to each dataset length) as uint8 RGB
+        
+        Datasets of equal frame shape and dtype are composited together in one combine_batch call.'''
+        
+        t0 = self._tic()
+        frames = [comp.image[min(t, comp.image.shape[0]-1)] for comp in self.compositors]
+        self._toc('slice', t0, *frames)
+        
+        if all(f.shape == frames[0].shape and f.dtype == frames[0].dtype for f in frames):
+            return list(self.combine_batch(np.stack(frames), colors = colors, contrast = contrast))
+        return [self.combine_batch(f[np.newaxis], colors = colors, contrast = contrast)[0] for f in frames]
+    
+    
+    def interactive_compare(self):
+        '''Create an interactive GUI showing all datasets with shared controls'''
+        
+        import ipywidgets as ipw
+        import matplotlib.pyplot as plt
+        from IPython.display import display
+        
+        ui_channels, ui = self.channel_controls()
+        
+        #define time slider covering the longest dataset
+        nframes = max(comp.image.shape[0] for comp in self.compositors)
+        time_slider = ipw.IntSlider(min=0, max = nframes-1, value = 0, description = 'Time')
+        
+        #define plotting function that automatically updates with widgets
+        def f(c0, c1, c2, t, col0, col1, col2):
+            
+            self.selected_colors = [col0, col1, col2]
+            self.selected_contrast = [c0,c1,c2]
+            
+            composites = self.combine_all(t)
+            
+            t0 = self._tic()
+            fig, axes = plt.subplots(1, len(composites), figsize=(4*len(composites),4), squeeze = False)
+            for ax, im_combined, name in zip(axes[0], composites, self.names):
+                ax.imshow(im_combined)
+                ax.set_title(name)
+                ax.set_axis_off()
+            self._toc('figure', t0)
+            
+            if self.profile:
+                self.stats_output.value = self.stats_html()
+        
+        out = ipw.interactive_output(f, {**ui_channels, 't': time_slider})
+        
+        if self.profile:
+            display(ipw.VBox([out, time_slider, ui, self.stats_output]))
+        else:
+            display(ipw.VBox([out, time_slider, ui]))
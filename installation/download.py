@@ -1,17 +1,275 @@
-import sys, os, zipfile
+"""
+Download the example data into Data/
+
+The archives are downloaded in parallel ranged chunks that are recorded as they
+complete, so an interrupted download resumes where it stopped. Only the needed
+members are extracted, streamed to disk while their CRC-32 is checked, and their
+SHA-256 is recorded in a manifest. When the manifest matches the files on disk
+nothing is downloaded.
+
+Archives are checked against the SHA-256 pinned in DATASETS. Archives without a
+pinned value have their SHA-256 recorded in the manifest on the first download,
+and later downloads, from any mirror, must match it. Delete the manifest to accept
+a new version of an archive.
+
+Usage:
+    python installation/download.py
+    python installation/download.py --base-url http://fileserver/images/ --output Data/
+    python installation/download.py --base-url /mnt/mirror/images/
+
+The base URL can also be set with the PYNTERACTIVE_DATA_URL environment
+variable. Local directories and file:// URLs are read in place without copying.
+"""
+
+# License: BSD3
+
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.parse
 import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_BASE_URL = 'http://mirror.imagej.net/images/'
+MANIFEST_FILE = '.download_manifest.json'
+CHUNK_SIZE = 4 * 1024**2
+
+#archive name: pinned SHA-256 of the archive (None to record it on the first download) and {member: saved name}
+DATASETS = {
+    'Spindly-GFP.zip': {'sha256': None, 'members': {'mitosis.tif': 'mitosis.tif'}},
+}
+
+
+def sha256_file(path, chunk_size = CHUNK_SIZE):
+    '''Return the SHA-256 hex digest of a file'''
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_json(path):
+    '''Load a JSON file, or return an empty dictionary if it does not exist'''
+
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def write_json(path, content):
+    '''Atomically save a JSON file'''
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump(content, f, indent = 2)
+    os.replace(path + '.tmp', path)
+
+
+def local_path(url):
+    '''Return the path of a file:// URL or plain path, None for remote URLs'''
+
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == 'file':
+        return urllib.request.url2pathname(parsed.path)
+    if len(parsed.scheme) <= 1:
+        #no scheme or a Windows drive letter
+        return url
+    return None
+
+
+def is_cached(spec, output, manifest):
+    '''Check that all members of an archive are on disk with the recorded size and checksum'''
+
+    for name in spec['members'].values():
+        entry = manifest.get(name)
+        path = os.path.join(output, name)
+        if entry is None or not os.path.exists(path) or os.path.getsize(path) != entry['size']:
+            return False
+        if sha256_file(path) != entry['sha256']:
+            return False
+    return True
+
+
+def remote_size(url):
+    '''Return the size of a remote file and whether the server accepts byte ranges'''
+
+    request = urllib.request.Request(url, headers = {'Range': 'bytes=0-0'})
+    with urllib.request.urlopen(request) as response:
+        if response.status == 206:
+            #Content-Range: bytes 0-0/size
+            return int(response.headers['Content-Range'].rsplit('/', 1)[1]), True
+        size = response.headers.get('Content-Length')
+        return (int(size) if size is not None else None), False
+
+
+def download(url, path, workers = 4, chunk_size = CHUNK_SIZE):
+    '''Download url to path in parallel ranged chunks, resuming a previous partial download
+
+    Completed chunks are recorded in path.part.json; servers without range support
+    are read in one stream whose length is checked against Content-Length.'''
+
+    part, state_path = path + '.part', path + '.part.json'
+    size, ranges = remote_size(url)
+
+    if not ranges or size is None:
+        received = 0
+        with urllib.request.urlopen(url) as response, open(part, 'wb') as f:
+            expected = response.headers.get('Content-Length')
+            for block in iter(lambda: response.read(chunk_size), b''):
+                f.write(block)
+                received += len(block)
+        if expected is not None and received != int(expected):
+            os.remove(part)
+            raise IOError('incomplete download of {}: {} of {} bytes'.format(url, received, expected))
+        os.replace(part, path)
+        return
+
+    state = read_json(state_path)
+    if state.get('url') != url or state.get('size') != size or state.get('chunk_size') != chunk_size \
+            or not os.path.exists(part):
+        state = {'url': url, 'size': size, 'chunk_size': chunk_size, 'done': []}
+        with open(part, 'wb') as f:
+            f.truncate(size)
+    done = set(state['done'])
+    todo = [i for i in range(-(-size // chunk_size)) if i not in done]
+    lock = threading.Lock()
+
+    def fetch_chunk(i):
+        start = i * chunk_size
+        end = min(start + chunk_size, size) - 1
+        request = urllib.request.Request(url, headers = {'Range': 'bytes={}-{}'.format(start, end)})
+        with urllib.request.urlopen(request) as response:
+            data = response.read()
+        if len(data) != end - start + 1:
+            raise IOError('incomplete chunk {} of {}'.format(i, url))
+        with open(part, 'r+b') as f:
+            f.seek(start)
+            f.write(data)
+        with lock:
+            done.add(i)
+            state['done'] = sorted(done)
+            write_json(state_path, state)
+
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        list(pool.map(fetch_chunk, todo))
+
+    os.replace(part, path)
+    os.remove(state_path)
+
+
+def find_member(archive, name):
+    '''Return the archive member matching name, ignoring folders and macOS metadata'''
+
+    names = [n for n in archive.namelist() if not n.startswith('__MACOSX/')]
+    if name in names:
+        return name
+    matches = [n for n in names if os.path.basename(n) == name]
+    if len(matches) != 1:
+        raise KeyError('{} not found in archive'.format(name))
+    return matches[0]
+
+
+def extract_member(archive_path, member, dest, chunk_size = CHUNK_SIZE):
+    '''Stream one archive member to dest and return its size and SHA-256
+
+    zipfile checks the CRC-32 of the member when the end of the stream is read.'''
+
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with zipfile.ZipFile(archive_path) as archive, archive.open(find_member(archive, member)) as source, \
+                open(dest + '.tmp', 'wb') as f:
+            for block in iter(lambda: source.read(chunk_size), b''):
+                digest.update(block)
+                f.write(block)
+                size += len(block)
+    except Exception:
+        if os.path.exists(dest + '.tmp'):
+            os.remove(dest + '.tmp')
+        raise
+    os.replace(dest + '.tmp', dest)
+    return {'size': size, 'sha256': digest.hexdigest()}
+
+
+def fetch(archive_name, spec, base_url, output, workers = 4, keep_archive = False, force = False):
+    '''Download and extract the members of one archive unless a verified copy is cached
+
+    The archive must match the pinned SHA-256 of spec, or else the one recorded in the
+    manifest by a previous download. A downloaded archive that fails verification or
+    extraction is deleted so that the next run downloads it again; force also
+    downloads a kept archive again.'''
+
+    manifest_path = os.path.join(output, MANIFEST_FILE)
+    if not force and is_cached(spec, output, read_json(manifest_path)):
+        print('cached ', archive_name)
+        return
+
+    url = base_url.rstrip('/') + '/' + archive_name
+    archive_path = local_path(url)
+    downloaded = archive_path is None
+    if downloaded:
+        archive_path = os.path.join(output, archive_name)
+        if force and os.path.exists(archive_path):
+            os.remove(archive_path)
+        if not os.path.exists(archive_path):
+            t0 = time.perf_counter()
+            download(url, archive_path, workers = workers)
+            print('fetched', archive_name, '{:.1f} s'.format(time.perf_counter() - t0))
+
+    recorded = read_json(manifest_path).get(archive_name, {}).get('sha256')
+    expected = spec['sha256'] if spec['sha256'] is not None else recorded
+    archive_sha256 = sha256_file(archive_path)
+    if expected is not None and archive_sha256 != expected:
+        if downloaded:
+            os.remove(archive_path)
+        raise IOError('checksum mismatch for {}: {} instead of {}'.format(url, archive_sha256, expected))
+
+    members = spec['members']
+    try:
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            entries = pool.map(lambda m: extract_member(archive_path, m, os.path.join(output, members[m])), members)
+            entries = dict(zip(members.values(), entries))
+    except (zipfile.BadZipFile, KeyError, IOError):
+        #a truncated or corrupted download must not be reused by later runs
+        if downloaded:
+            os.remove(archive_path)
+        raise
+
+    manifest = read_json(manifest_path)
+    for name, entry in entries.items():
+        manifest[name] = dict(entry, source = url)
+    manifest[archive_name] = {'size': os.path.getsize(archive_path), 'sha256': archive_sha256, 'source': url}
+    write_json(manifest_path, manifest)
+    print('extracted', ', '.join(entries))
+    if expected is None:
+        print('recorded', archive_name, 'sha256', archive_sha256)
+
+    if downloaded and not keep_archive:
+        os.remove(archive_path)
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Download the example data')
+    parser.add_argument('--base-url', default = os.environ.get('PYNTERACTIVE_DATA_URL', DEFAULT_BASE_URL),
+                        help = 'URL or directory containing the archives')
+    parser.add_argument('--output', default = 'Data/', help = 'directory to save the data to')
+    parser.add_argument('--workers', type = int, default = 4, help = 'parallel connections')
+    parser.add_argument('--keep-archive', action = 'store_true', help = 'keep downloaded archives')
+    parser.add_argument('--force', action = 'store_true', help = 'download even if a verified copy exists')
+    args = parser.parse_args(argv)
 
-#where_to_save = '../Data/'
-where_to_save = 'Data/'
+    os.makedirs(args.output, exist_ok = True)
+    for archive_name, spec in DATASETS.items():
+        fetch(archive_name, spec, args.base_url, args.output, workers = args.workers,
+              keep_archive = args.keep_archive, force = args.force)
 
-#create data directory
-if not os.path.exists(where_to_save):
-    os.makedirs(where_to_save)
-    
 
-url = 'http://mirror.imagej.net/images/Spindly-GFP.zip'
-urllib.request.urlretrieve(url, where_to_save+'mitosis.zip')
-#unzip
-with zipfile.ZipFile(where_to_save+'mitosis.zip', 'r') as zip_ref:
-    zip_ref.extractall(where_to_save)
-os.remove(where_to_save+'mitosis.zip')
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -341,7 +341,9 @@
 
 ## Supply overrides for the tornado.web.Application that the Jupyter notebook
 #  uses.
-c.NotebookApp.tornado_settings = {"websocket_max_message_size": 100 * 1024 * 1024}
+#frames of interactive_view are sent as small tiles, the largest message left is
+#the histogram movie, well below the tornado default of 10 MB
+c.NotebookApp.tornado_settings = {"websocket_max_message_size": 10 * 1024 * 1024}
 
 ## Whether to trust or not X-Scheme/X-Forwarded-Proto and X-Real-Ip/X-Forwarded-
 #  For headerssent by the upstream reverse proxy. Necessary if the proxy handles